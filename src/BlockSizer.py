@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+import threading
+
+__date__ = 20261018
+
+
+class BlockSizer:
+    """
+    Choose the number of documents of each efetch request from the observed
+    latency and size of the previous answers. The size grows while the
+    answers are fast, shrinks when they are slow and is halved after a
+    failed (timeout, server error, truncated answer) request, always inside
+    [minSize, maxSize]. It is thread safe.
+    """
+
+    def __init__(self,
+                 size=50,
+                 minSize=None,
+                 maxSize=None,
+                 targetSeconds=5.0,
+                 maxBytes=32 * 1024 * 1024):
+        """
+
+        size - initial block size
+        minSize - minimum block size. If None 'size' is used
+        maxSize - maximum block size (efetch maximum is 10000). If None
+                  'size' is used. If minSize == maxSize the size is fixed
+        targetSeconds - answers faster than that make the block grow, and
+                        slower than twice that make it shrink
+        maxBytes - maximum expected size of an answer
+        """
+        self.minSize = size if minSize is None else minSize
+        self.maxSize = size if maxSize is None else maxSize
+        if self.minSize < 1 or self.minSize > self.maxSize:
+            raise Exception("Invalid block size bounds")
+
+        self.size = float(min(max(size, self.minSize), self.maxSize))
+        self.targetSeconds = targetSeconds
+        self.maxBytes = maxBytes
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def getSize(self):
+        """Return the size of the next block."""
+        with self.lock:
+            return int(self.size)
+
+    def canShrink(self,
+                  size):
+        """
+
+        size - number of documents of a failed request
+        Returns True if the request can be retried with less documents
+        """
+        return self.minSize < self.maxSize and size > self.minSize
+
+    def success(self,
+                size,
+                seconds,
+                numBytes):
+        """
+        Register a successful request.
+
+        size - number of requested documents
+        seconds - duration of the request
+        numBytes - size of the answer
+        """
+        with self.lock:
+            self.requests += 1
+            if seconds > 2 * self.targetSeconds:
+                newSize = self.size * 0.75
+            elif seconds < self.targetSeconds and size >= int(self.size):
+                newSize = max(self.size * 1.25, self.size + 1)
+            else:
+                newSize = self.size
+
+            if numBytes > 0 and size > 0:  # do not exceed maxBytes
+                newSize = min(newSize, self.maxBytes * size / numBytes)
+
+            self.size = min(max(newSize, self.minSize), self.maxSize)
+
+    def failure(self):
+        """Register a failed request."""
+        with self.lock:
+            self.requests += 1
+            self.failures += 1
+            self.size = max(self.size / 2, self.minSize)
+
+    def getErrorRate(self):
+        """Return the fraction of failed requests."""
+        with self.lock:
+            return self.failures / self.requests if self.requests else 0.0
@@ -22,9 +22,18 @@
 #
 # =========================================================================
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
+import re
+import threading
 import time
-from LoadUrl import loadUrl
-from XML import MyXML
+import xml.etree.ElementTree as ET
+from BlockSizer import BlockSizer
+from EUtils import getSharedEUtils
+from NLM_API import NLM_API
+from RetryPolicy import RetryPolicy
+from XML import MyXML, isSimplePath, iterElements, iterRawElements
 
 __date__ = 20160418
 
@@ -37,7 +46,21 @@ class DocIterator:
                  retType="MEDLINE",
                  retMode="XML",
                  xpathSplit="PubmedArticleSet/PubmedArticle",
-                 verbose=True):
+                 verbose=True,
+                 eutils=None,
+                 webEnv=None,
+                 queryKey=None,
+                 useEPost=False,
+                 startPos=0,
+                 xpathId="MedlineCitation/PMID",
+                 prefetch=0,
+                 workers=1,
+                 ordered=True,
+                 blockSize=50,
+                 minBlockSize=None,
+                 maxBlockSize=None,
+                 rawBytes=False,
+                 parseDoc=None):
         """
 
         ids - list of xml document ids to be downloaded
@@ -48,99 +71,420 @@ class DocIterator:
                      documents from the big one downloaded with efetch
         verbose - if True print a dot in the standard output when a block
                   is loaded
+        eutils - EUtils object used to send the requests. If None the
+                 process wide one is used
+        webEnv - web environment of a search stored in the Entrez history
+                 server (see NLM_API.getAllIdsHistory). If present, the
+                 documents are fetched from the history by position and 'ids'
+                 should be the id list of that search in the same order
+        queryKey - query key of the search stored in the history server
+        useEPost - if True the whole id list is uploaded once with epost and
+                   the blocks are fetched from the history server by
+                   position instead of posting their ids. The ids are then
+                   iterated in the order of the history server
+        startPos - position (in ids) of the first document to be downloaded.
+                   Used to resume a broken download
+        xpathId - the xpath expression (relative to a splitted document) of
+                  its id. Used to pair documents and ids when they are
+                  fetched from the history server
+        prefetch - number of blocks downloaded in advance by a background
+                   thread while the current block is consumed. If 0 a block
+                   is only downloaded when the previous one is consumed
+        workers - number of blocks downloaded at the same time (all of them
+                  respecting the EUtils rate limit)
+        ordered - if True the documents are returned in the ids order. If
+                  False the blocks are returned as soon as they are
+                  downloaded (getPosition is then meaningless)
+        blockSize - number of documents of each efetch request
+        minBlockSize - if present (with maxBlockSize) the block size is
+                       adapted to the observed latency, answer size and
+                       errors but not below that
+        maxBlockSize - maximum adapted block size
+        rawBytes - if True the xml documents are returned as memoryview
+                   slices of the downloaded bytes, identical to the NCBI
+                   ones and without parsing/serialization. It requires a
+                   simple xpathSplit (tags separated by '/')
+        parseDoc - function that receives the xml element of a document and
+                   returns its structured form, for example XML.elementToDict.
+                   If present, the iterator returns tuples (<id>, <xml
+                   document>, <structured document>) produced by a single
+                   parse of the downloaded xml
         """
-        base = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-        size = 50  # 100
 
         self.ids = ids
         self.total = len(ids)
-        self.remaining = self.total
+        self.remaining = self.total - startPos
 
         if self.total == 0:
             raise Exception("Empty id list")
+        if startPos < 0 or startPos > self.total:
+            raise Exception("Invalid startPos: " + str(startPos))
 
-        if self.total > size:
-            self.blockSize = size
-        else:
-            self.blockSize = self.total
+        self.sizer = BlockSizer(min(blockSize, self.total),
+                                minBlockSize, maxBlockSize)
+        self.shrinkPolicy = None  # see __fetchBlock
 
-        self.curBlock = 0
+        self.blkStart = startPos  # position of the first doc of xmlBlock
+        self.nextPos = startPos   # position of the first doc of next block
         self.curBlkPos = 0
         self.xmlBlock = []
         self.xpath = xpathSplit
-        self.url = base
-        self.postParam = {"db": dbName, "retmax": str(self.blockSize),
-                          "rettype": retType, "retmode": retMode}
+        self.xpathId = xpathId
+        self.quarantine = []  # ids that NCBI did not return
+        self.rawBytes = rawBytes
+        self.parseDoc = parseDoc
+        if rawBytes:
+            if not isSimplePath(xpathSplit):
+                raise Exception("rawBytes requires a simple xpathSplit")
+            idTag = re.escape(xpathId.split("/")[-1].encode("utf-8"))
+            self.rawId = re.compile(b"<" + idTag +
+                                    rb"(?:\s[^>]*)?>\s*([^<\s]+)")
+        self.eutils = getSharedEUtils() if eutils is None else eutils
+        if self.sizer.minSize < self.sizer.maxSize:
+            # A block that can still shrink is not retried with the same
+            # size: the first failure goes to the sizer.
+            self.shrinkPolicy = RetryPolicy(
+                maxRetries=0, timeout=self.eutils.retryPolicy.timeout)
+        self.url = self.eutils.base + "/efetch.fcgi"
+        self.postParam = {"db": dbName, "rettype": retType,
+                          "retmode": retMode}
+        if useEPost and webEnv is None:
+            webEnv, queryKey = self.__postIds(dbName)
+            self.ids = self.__getHistoryOrder(dbName, webEnv, queryKey)
+            self.total = len(self.ids)  # epost removes repeated ids
+            self.remaining = self.total - startPos
+        if webEnv is not None:
+            self.postParam["WebEnv"] = webEnv
+            self.postParam["query_key"] = queryKey
+        self.webEnv = webEnv
+        self.queryKey = queryKey
+        self.useHistory = webEnv is not None
         self.verbose = verbose
-        self.__loadBlock(0)
+
+        self.prefetch = prefetch
+        self.workers = max(1, workers)
+        self.ordered = ordered
+        self.blocks = None  # queue of blocks filled by the prefetch thread
+        # StopIteration or download error that ended the iteration. The
+        # prefetch thread is finished, so it is raised again by next calls.
+        self.end = None
+        self.stopEvent = threading.Event()
+        if prefetch > 0 or self.workers > 1:
+            self.blocks = queue.Queue(maxsize=max(1, prefetch))
+            thread = threading.Thread(target=self.__prefetchBlocks,
+                                      daemon=True)
+            thread.start()
 
     def __iter__(self):
         """Turn this class iterable."""
         return self
 
     def __next__(self):
-        """Return the next pair (<id>,<downloaded xml document>)."""
-        xml = None
-        if self.curBlkPos < len(self.xmlBlock):
-            # print("next - proximo documento [" + str(self.curBlkPos) + "] já está carragado. Tome-o!", flush=True)
-            xml = self.xmlBlock[self.curBlkPos]
-            self.remaining -= 1
-            self.curBlkPos += 1
-        else:
-            self.__loadBlock(self.curBlock + 1)
-            xml = self.__next__()
+        """
+        Return the next pair (<id>,<downloaded xml document>) or the tuple
+        (<id>, <downloaded xml document>, <structured document>) if parseDoc
+        is present.
+        """
+        while self.curBlkPos >= len(self.xmlBlock):
+            self.__loadBlock()
+
+        # print("next - proximo documento [" + str(self.curBlkPos) + "] já está carragado. Tome-o!", flush=True)
+        xml = self.xmlBlock[self.curBlkPos]
+        self.remaining -= 1
+        self.curBlkPos += 1
 
         return xml
 
-    def __loadBlock(self,
-                    blkNumber,
-                    waitSeconds=30):
+    def close(self):
+        """Stop the download threads if the iteration is abandoned."""
+        self.stopEvent.set()
+
+    def getQuarantine(self):
+        """
+        Return the list of ids, of the already returned blocks, whose
+        documents could not be downloaded (for example withdrawn PMIDs).
+        """
+        return list(self.quarantine)
+
+    def getPosition(self):
+        """
+        Return the position (in ids) of the next document to be returned. It
+        can be used as the startPos of a new DocIterator to resume the
+        download.
+        """
+        if self.curBlkPos >= len(self.xmlBlock):
+            return self.nextPos
+        # ids of quarantined documents are not counted, so the position can
+        # be a little before the real one but never after it.
+        return self.blkStart + self.curBlkPos
+
+    def getCheckpoint(self):
+        """
+        Return a dictionary with the state needed to resume the download in
+        another DocIterator: the ids, the position of the next document to
+        be returned, the history server WebEnv/query_key and the quarantined
+        ids. It requires ordered=True.
+        """
+        return {"ids": list(self.ids), "position": self.getPosition(),
+                "webEnv": self.webEnv, "queryKey": self.queryKey,
+                "quarantine": self.getQuarantine()}
+
+    def __postIds(self,
+                  dbName):
+        """
+        Upload the id list to the Entrez history server.
+
+        dbName - database  name
+        Returns a pair (<webenv>, <querykey>)
+        """
+        postParam = {"db": dbName, "id": ",".join(map(str, self.ids))}
+        xmlRes = self.eutils.load("epost.fcgi", postParam, post=True)
+        if xmlRes[0] != 200:
+            raise Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
+                            str(xmlRes[1]) + " utility:epost.fcgi")
+
+        xml = MyXML(xmlRes[1])
+        webEnv = xml.getXPath("ePostResult/WebEnv")
+        queryKey = xml.getXPath("ePostResult/QueryKey")
+        if not webEnv or not queryKey:
+            raise Exception("Invalid epost result: " + str(xmlRes[1]))
+
+        return webEnv[0][0], queryKey[0][0]
+
+    def __getHistoryOrder(self,
+                          dbName,
+                          webEnv,
+                          queryKey):
         """
-        Load the document buffer with the next documents.
+        The history server does not keep the order of the posted ids, so the
+        blocks fetched by position must follow its order.
 
-        blkNumber - the block number to be downloaded (initial block is 0)
-        waitSeconds - number of seconds the program will sleep it download
-                      fails
+        dbName - database  name
+        webEnv - web environment of the posted ids
+        queryKey - query key of the posted ids
+        Returns the ids in the history server order. Posted ids absent from
+        it are kept at the end (they will be quarantined)
         """
+        api = NLM_API(self.eutils)
+        histIds = []
+        for retStart in range(0, self.total, 10000):
+            histIds.extend(api.getHistoryIds(dbName, webEnv, queryKey,
+                                             10000, retStart))
+        posted = set(map(str, self.ids))
+        histIds = [id_ for id_ in histIds if id_ in posted]
+        histSet = set(histIds)
+
+        return histIds + [id_ for id_ in dict.fromkeys(map(str, self.ids))
+                          if id_ not in histSet]
+
+    def __loadBlock(self):
+        """Load the document buffer with the next documents."""
         # print("__loadBlock - carregando próximo bloco de documentos.", flush=True)
+        if self.end is not None:
+            raise self.end
+        if self.blocks is None:
+            block = self.__fetchBlock(self.nextPos, self.sizer.getSize())
+        else:
+            block = self.blocks.get()
+            if isinstance(block, BaseException):
+                self.end = block
+                raise block
+
+        if block is None:
+            if self.remaining > 0:
+                self.end = Exception("Not all documents were made available "
+                                     "by iterator. Remaining docs= " +
+                                     str(self.remaining) + " Position=" +
+                                     str(self.nextPos) + " Total docs=" +
+                                     str(self.total))
+                raise self.end
+            # print("__loadBlock - não vou carregar nada pois o último bloco carragável já foi lido", flush=True)
+            self.end = StopIteration()
+            raise self.end
+
+        self.blkStart, self.nextPos, self.xmlBlock, badIds = block
+        self.curBlkPos = 0
+        if badIds:
+            self.remaining -= len(badIds)
+            self.quarantine.extend(badIds)
+            if self.verbose:
+                print("(bad ids: " + ",".join(map(str, badIds)) + ")",
+                      end="", flush=True)
+        # print("__loadBlock - Total de documentos feito o xpath:" + str(len(block)), flush=True)
+
+    def __prefetchBlocks(self):
+        """
+        Download the blocks with up to 'workers' concurrent requests and put
+        them into the block queue (in ids order if 'ordered' is True). It
+        runs in a background thread. A download error is put into the queue
+        to be raised by the consumer.
+        """
+        retStart = self.nextPos
+        pending = deque()  # futures in submission order
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopEvent.is_set():
+                while len(pending) < self.workers and retStart < self.total:
+                    size = self.sizer.getSize()
+                    pending.append(executor.submit(self.__fetchBlock,
+                                                   retStart, size))
+                    retStart = min(retStart + size, self.total)
+
+                if not pending:
+                    block = None
+                else:
+                    if self.ordered:
+                        future = pending.popleft()
+                    else:
+                        done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                        future = done.pop()
+                        pending.remove(future)
+                    try:
+                        block = future.result()
+                    except BaseException as ex:
+                        block = ex
+
+                while not self.stopEvent.is_set():
+                    try:
+                        self.blocks.put(block, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+
+                if block is None or isinstance(block, BaseException):
+                    self.stopEvent.set()  # cancels the pending downloads
+                    for future in pending:
+                        future.cancel()
+
+    def __fetchBlock(self,
+                     retStart,
+                     size):
+        """
+        Download a block of documents. If the block size is adaptive, a
+        failed request or a truncated answer is retried at once with less
+        documents until the whole block is downloaded. Only requests of
+        the minimum size use all the EUtils retries.
+        Documents missing from an answer are requested again (see
+        __recoverIds). A non transient http error raises an exception.
+
+        retStart - the position (in ids) of the first document of the block
+        size - maximum number of documents of the block
+        Returns a tuple (<retStart>, <position of the next block>, <list of
+        pairs (<id>, <xml document>)>, <list of ids whose documents could not
+        be downloaded>) or None if there is no more documents
+        """
+        if retStart >= self.total:
+            return None
+
         if self.verbose:
-            if waitSeconds == 30:
-                print('.', end="", flush=True)
+            print('.', end="", flush=True)
 
-        block = []
-        retStart = blkNumber * self.blockSize
-        if retStart < self.total:
-            # print("__loadBlock - preciso saber os identificadores dos documentos a serem carregados.", flush=True)
-            pair = self.__getIds(retStart)
-            self.postParam["id"] = pair[1]
-            xmlRes = loadUrl(self.url, post_values=self.postParam)
-            del self.postParam["id"]
-            if xmlRes[0] == 200:
-                # print("res=" + str(xmlRes[1]))
-                block = self.__splitBlock(pair[0], xmlRes[1])
-                self.curBlock = blkNumber
-                self.curBlkPos = 0
-                self.xmlBlock = block
-                # print("__loadBlock - Total de documentos feito o xpath:" + str(len(block)), flush=True)
+        last = min(retStart + size, self.total)
+        pos = retStart
+        reqSize = last - retStart
+        docs = {}  # id -> document tuple
+        badIds = []
+
+        while pos < last:
+            reqSize = min(reqSize, last - pos)
+            pair = self.__getIds(pos, reqSize)
+            postParam = dict(self.postParam)
+            postParam["retmax"] = str(reqSize)
+            if self.useHistory:
+                postParam["retstart"] = str(pos)
             else:
-                # print("__loadBlock - problemas ao carragar bloco de documentos. Vou tentar novamente.", flush=True)
-                if waitSeconds <= 3600:  # waits up to 1 hour and try again
-                    if self.verbose:
-                        print("(" + str(waitSeconds) + "s)", end="",
-                              flush=True)
-                    time.sleep(waitSeconds)
-                    self.__loadBlock(blkNumber, waitSeconds * 2)
+                postParam["id"] = pair[1]
+
+            begin = time.time()
+            if self.sizer.canShrink(reqSize):
+                xmlRes = self.eutils.load("efetch.fcgi", postParam, post=True,
+                                          retryPolicy=self.shrinkPolicy)
+            else:
+                xmlRes = self.eutils.load("efetch.fcgi", postParam, post=True)
+            seconds = time.time() - begin
+
+            error = None
+            if xmlRes[0] == 200:
+                try:
+                    # print("res=" + str(xmlRes[1]))
+                    found, missing = self.__splitBlock(pair[0], xmlRes[1])
+                except ET.ParseError as ex:  # truncated answer
+                    error = ex
+            elif self.eutils.retryPolicy.isTransient(xmlRes[0]):
+                error = Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
+                                  str(xmlRes[1]) + " url:" + self.url)
+            else:  # permanent error (invalid request, api_key, ...)
+                raise Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
+                                str(xmlRes[1]) + " url:" + self.url)
+
+            if error is not None:
+                # Try again with a smaller block (at the minimum size the
+                # transient errors were already retried by EUtils).
+                if not self.sizer.canShrink(reqSize):
+                    raise error
+                self.sizer.failure()
+                reqSize = max(self.sizer.minSize,
+                              min(self.sizer.getSize(), reqSize // 2))
+                continue
+
+            self.sizer.success(reqSize, seconds, len(xmlRes[1]))
+            if missing:
+                recovered, bad = self.__recoverIds(missing)
+                found.extend(recovered)
+                badIds.extend(bad)
+            for doc in found:
+                docs[str(doc[0])] = doc
+            pos += len(pair[0])
+            reqSize = self.sizer.getSize()
+
+        block = []
+        for idx in range(retStart, last):
+            doc = docs.get(str(self.ids[idx]))
+            if doc is not None:
+                block.append(doc)
+
+        return retStart, last, block, badIds
+
+    def __recoverIds(self,
+                     ids):
+        """
+        Request again, by id, documents that were not returned. A list that
+        still has missing documents is split in two until the invalid ids
+        are isolated. A request that fails (not 200) raises an exception.
+
+        ids - list of ids whose documents were not returned
+        Returns a pair (<list of found documents>, <list of invalid ids>)
+        """
+        found = []
+        badIds = []
+        pending = [ids]
+
+        while pending:
+            part = pending.pop()
+            postParam = {"db": self.postParam["db"],
+                         "rettype": self.postParam["rettype"],
+                         "retmode": self.postParam["retmode"],
+                         "retmax": str(len(part)),
+                         "id": ",".join(map(str, part))}
+            xmlRes = self.eutils.load("efetch.fcgi", postParam, post=True)
+            if xmlRes[0] != 200:
+                # Only ids missing from a 200 answer are invalid ones
+                raise Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
+                                str(xmlRes[1]) + " url:" + self.url)
+            docs, missing = self.__splitBlock(part, xmlRes[1])
+            found.extend(docs)
+
+            if len(part) == 1:
+                badIds.extend(missing)
+            elif missing:
+                half = len(missing) // 2
+                if half > 0:
+                    pending.append(missing[half:])
+                    pending.append(missing[:half])
                 else:
-                    # print("__loadBlock - não consegui carragar bloco de documentos.", flush=True)
-                    raise Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
-                                    xmlRes[1] + " url:" + self.url)
-        else:
-            if self.remaining > 0:
-                raise Exception("Not all documents were made available by iterator." +
-                " Remaining docs= " + str(self.remaining) + " Block number=" +
-                str(blkNumber) + " Total docs=" + str(self.total))
-            # print("__loadBlock - não vou carregar nada pois o último bloco carragável já foi lido", flush=True)
-            raise StopIteration()
+                    pending.append(missing)
+
+        return found, badIds
 
     def __splitBlock(self,
                      ids,
@@ -151,32 +495,82 @@ class DocIterator:
 
         ids = list of document ids
         xml - the downloaded xml to be splited
-        Returns a list of pairs (<id>, <xml document>)
+        Returns a pair (<list of pairs (<id>, <xml document>) or, if
+        parseDoc is present, of tuples (<id>, <xml document>, <parsed
+        document>)>, <list of ids whose documents were not returned>)
         """
         ret = []
-        mxml = MyXML(xml)
-        idx = 0
-        elems = mxml.getXPathElements(self.xpath)
-        if len(ids) != len(elems):
-            raise Exception("Invalid retrieved xml documents")
+        missing = []
+        docs = []  # tuples (<document own id>, <xml document>[, <parsed>])
+        parse = self.parseDoc
+
+        if self.rawBytes:
+            slices = list(iterRawElements(xml, self.xpath))
+            if parse is None:
+                # The first xpathId tag of each slice is the document id.
+                for doc in slices:
+                    match = self.rawId.search(doc)
+                    docs.append((match.group(1).decode("utf-8")
+                                 if match else None, doc))
+            else:
+                # One parse gives the ids and the parsed documents.
+                idx = 0
+                for elem in iterElements(xml, self.xpath):
+                    if idx >= len(slices):
+                        raise Exception("Invalid retrieved xml documents")
+                    docs.append((elem.findtext(self.xpathId), slices[idx],
+                                 parse(elem)))
+                    idx += 1
+        elif isSimplePath(self.xpath):
+            # Each document is serialized (and parsed) as soon as it is read
+            # and then discarded from the tree.
+            for elem in iterElements(xml, self.xpath):
+                doc = (elem.findtext(self.xpathId),
+                       ET.tostring(elem, "unicode").strip())
+                docs.append(doc if parse is None else doc + (parse(elem),))
+        else:
+            mxml = MyXML(xml)
+            for elem in mxml.getXPathElements(self.xpath):
+                doc = (elem.findtext(self.xpathId),
+                       mxml.getTreeString(elem).strip())
+                docs.append(doc if parse is None else doc + (parse(elem),))
 
-        for elem in elems:
-            ret.append((ids[idx], mxml.getTreeString(elem).strip()))
-            idx += 1
+        # Pair documents and ids using the documents own ids, so a missing
+        # document does not shift the others. If the documents have no
+        # ids, pair them by position.
+        docMap = {}
+        for doc in docs:
+            if doc[0] is not None:
+                docMap[doc[0]] = doc
+
+        if len(docMap) == len(docs):
+            for id_ in ids:
+                doc = docMap.get(str(id_))
+                if doc is None:
+                    missing.append(id_)
+                else:
+                    ret.append((id_,) + doc[1:])
+        elif len(ids) == len(docs) and not self.useHistory:
+            for idx, doc in enumerate(docs):
+                ret.append((ids[idx],) + doc[1:])
+        else:
+            raise Exception("Invalid retrieved xml documents")
 
-        return ret
+        return ret, missing
 
     def __getIds(self,
-                 retStart):
+                 retStart,
+                 size):
         """
         Retrieve the next ids to be used to download the xml documents.
 
         retStart - the initial id position
+        size - maximum number of ids
         Returns a pair (<list of ids>, <string with next ids>)
         """
         ids_ = []
         strg = ""
-        last = min(retStart + self.blockSize, self.total)
+        last = min(retStart + size, self.total)
         first = True
 
         for idx in range(retStart, last):
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+from os.path import join
+import tempfile
+import urllib.parse
+from LoadUrl import httpPool
+from RateLimiter import RateLimiter
+from RetryPolicy import RetryPolicy
+
+__date__ = 20261018
+
+
+class EUtils:
+    """
+    Entry point of all NCBI E-utility requests. Every request waits for the
+    rate limiter and receives the tool, email and api_key parameters (see
+    E-utility_Recommendations.md).
+    """
+
+    def __init__(self,
+                 tool="API-NLM",
+                 email=None,
+                 apiKey=None,
+                 rate=None,
+                 burst=1,
+                 stateFile=join(tempfile.gettempdir(), "api_nlm_eutils.rate"),
+                 pool=None,
+                 retryPolicy=None,
+                 base="http://eutils.ncbi.nlm.nih.gov/entrez/eutils"):
+        """
+
+        tool - name of the software registered at NCBI
+        email - e-mail of the developer registered at NCBI
+        apiKey - NCBI api key. If present the default rate is 10 requests/s
+        rate - number of allowed requests per second. If None 3 (no api key)
+               or 10 (with api key) is used
+        burst - maximum number of requests that can be sent at once
+        stateFile - file used to share the rate limit among all harvester
+                    processes of the host. If None the limit is per process
+        pool - HttpPool object used to send requests. If None the shared
+               LoadUrl pool is used
+        retryPolicy - RetryPolicy object applied to every request. If None a
+                      RetryPolicy with default values is used
+        base - E-utilities base url
+        """
+        if rate is None:
+            rate = 3 if apiKey is None else 10
+
+        self.tool = tool
+        self.email = email
+        self.apiKey = apiKey
+        self.limiter = RateLimiter(rate, burst, stateFile)
+        self.pool = httpPool if pool is None else pool
+        self.retryPolicy = RetryPolicy() if retryPolicy is None \
+            else retryPolicy
+        self.base = base
+
+    def getParams(self,
+                  params):
+        """
+
+        params - dictionary of the request parameters
+        Returns a new dictionary with the tool, email and api_key parameters
+        """
+        ret = dict(params)
+        if self.tool is not None:
+            ret["tool"] = self.tool
+        if self.email is not None:
+            ret["email"] = self.email
+        if self.apiKey is not None:
+            ret["api_key"] = self.apiKey
+
+        return ret
+
+    def request(self,
+                utility,
+                params,
+                post=False,
+                retryPolicy=None):
+        """
+        Send a request to an E-utility respecting the rate limit. Transient
+        errors are retried according to the retry policy.
+
+        utility - E-utility name, for example 'esearch.fcgi'
+        params - dictionary of the request parameters
+        post - if True the parameters are sent with POST otherwise with GET
+        retryPolicy - RetryPolicy used instead of the default one for this
+                      request
+        Returns a tuple (<status>, <content>, <response headers>)
+        """
+        url = self.base + "/" + utility
+        allParams = self.getParams(params)
+        if post:
+            postValues = allParams
+        else:
+            postValues = None
+            url += "?" + urllib.parse.urlencode(allParams)
+
+        def send(timeout):
+            self.limiter.acquire()
+            return self.pool.request(url, post_values=postValues,
+                                     timeout=timeout)
+
+        if retryPolicy is None:
+            retryPolicy = self.retryPolicy
+        return retryPolicy.call(send)
+
+    def load(self,
+             utility,
+             params,
+             post=False,
+             retryPolicy=None):
+        """
+        Same as request but with the loadUrl return contract.
+
+        Returns a pair (<status>, <content>)
+        """
+        resp = self.request(utility, params, post, retryPolicy)
+
+        return resp[0], resp[1]
+
+
+# EUtils object used when none is given to NLM_API or DocIterator
+sharedEUtils = None
+
+
+def getSharedEUtils():
+    """Return the process wide EUtils object creating it if necessary."""
+    global sharedEUtils
+
+    if sharedEUtils is None:
+        sharedEUtils = EUtils()
+
+    return sharedEUtils
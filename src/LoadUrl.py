@@ -22,8 +22,8 @@
 #
 # =========================================================================
 
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+import http.client
+import threading
 import urllib.parse
 
 __date__ = 20160418
@@ -82,6 +82,8 @@ responses = {
           'Cannot satisfy request range.'),
     417: ('Expectation Failed',
           'Expect condition could not be satisfied.'),
+    429: ('Too Many Requests',
+          'The user has sent too many requests in a given amount of time.'),
 
     500: ('Internal Server Error', 'Server got itself in trouble'),
     501: ('Not Implemented',
@@ -95,10 +97,216 @@ responses = {
 }
 
 
+class HttpPool:
+    """
+    Pool of persistent (keep-alive) http connections. Idle connections are
+    kept by (scheme, host, port) and reused by the next request to the same
+    server, avoiding a new TCP connection (and TLS handshake) per request.
+    The pool is thread safe.
+    """
+
+    def __init__(self,
+                 maxPerHost=4,
+                 maxRedirects=5):
+        """
+
+        maxPerHost - maximum number of idle connections kept for each host
+        maxRedirects - maximum number of followed redirections of a request
+        """
+        self.maxPerHost = maxPerHost
+        self.maxRedirects = maxRedirects
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def __getConnection(self,
+                        key,
+                        timeout):
+        """
+        Return an idle connection to the server or create a new one.
+
+        key - tuple (<scheme>, <host>, <port>)
+        timeout - socket timeout in seconds (None means no timeout)
+        Returns a pair (<connection>, <True if the connection was reused>)
+        """
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+
+        return self.__newConnection(key, timeout), False
+
+    def __newConnection(self,
+                        key,
+                        timeout):
+        """
+        Create a new connection to the server.
+
+        key - tuple (<scheme>, <host>, <port>)
+        timeout - socket timeout in seconds (None means no timeout)
+        Returns the http connection
+        """
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def __dropIdle(self,
+                   key):
+        """
+        Close the idle connections to a server (used when one of them was
+        found closed by the server, the others are probably closed too).
+
+        key - tuple (<scheme>, <host>, <port>)
+        """
+        with self.lock:
+            conns = self.idle.pop(key, [])
+        for conn in conns:
+            conn.close()
+
+    def __releaseConnection(self,
+                            key,
+                            conn):
+        """
+        Give back a connection to the pool or close it if the pool is full.
+
+        key - tuple (<scheme>, <host>, <port>)
+        conn - the http connection
+        """
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxPerHost:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def __send(self,
+               key,
+               method,
+               path,
+               body,
+               header,
+               timeout):
+        """
+        Send a request and read the whole response. A reused connection
+        closed by the server is replaced once by a new connection (not by
+        another idle one, which is probably closed too).
+
+        Returns a tuple (<status>, <content>, <response headers>)
+        """
+        conn, reused = self.__getConnection(key, timeout)
+        while True:
+            try:
+                conn.request(method, path, body, header)
+                response = conn.getresponse()
+                content = response.read()
+                break
+            except (http.client.RemoteDisconnected,
+                    BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if not reused:
+                    raise
+                self.__dropIdle(key)
+                conn = self.__newConnection(key, timeout)
+                reused = False
+            except BaseException:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.__releaseConnection(key, conn)
+
+        return response.status, content, response.msg
+
+    def request(self,
+                url,
+                header={'User-Agent':
+                        'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'},
+                post_values=None,  # if None => GET else POST
+                post_values_encod='ascii',
+                timeout=None):
+        """
+
+        url - the internet address of the content to be downloaded
+        header - dictionary of the http send header
+        post_values - dictionary of the POST parameters. If None is used the
+                      send protocol used would be GET
+        post_values_encod - the encoding used in post_values dictionary
+        timeout - socket timeout in seconds (None means no timeout)
+        Returns a tuple (<status>, <content>, <response headers>). If the
+        status is not 2xx the content is the http reason phrase. If the
+        request could not be sent the status is -1, the content is the error
+        message and the headers are None.
+        """
+        header = dict(header)
+        if post_values is None:
+            method = "GET"
+            body = None
+        else:
+            method = "POST"
+            body = urllib.parse.urlencode(post_values)
+            body = body.encode(post_values_encod)
+            header.setdefault("Content-Type",
+                              "application/x-www-form-urlencoded")
+
+        try:
+            for redirect in range(self.maxRedirects + 1):
+                parts = urllib.parse.urlsplit(url)
+                scheme = parts.scheme.lower()
+                port = parts.port
+                if port is None:
+                    port = 443 if scheme == "https" else 80
+                key = (scheme, parts.hostname, port)
+                path = parts.path or "/"
+                if parts.query:
+                    path += "?" + parts.query
+
+                status, content, headers = self.__send(key, method, path,
+                                                       body, header, timeout)
+                location = headers.get("Location")
+                if status in (301, 302, 303, 307, 308) and location:
+                    url = urllib.parse.urljoin(url, location)
+                    if status not in (307, 308):
+                        method = "GET"
+                        body = None
+                        header.pop("Content-Type", None)
+                    continue
+                break
+
+            if 200 <= status < 300:
+                resp = (status, content, headers)
+            else:
+                reason = responses.get(status, ("Unknown",))[0]
+                resp = (status, reason, headers)
+        except BaseException as bex:
+            resp = (-1, str(bex), None)
+
+        return resp
+
+
+# Connection pool shared by all loadUrl callers (NLM_API, DocIterator, ...)
+httpPool = HttpPool()
+
+
 def loadUrl(url,
             header={'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'},
             post_values=None,  # if None => GET else POST
-            post_values_encod='ascii'):
+            post_values_encod='ascii',
+            pool=None):
     """
 
     url - the internet address of the content to be downloaded
@@ -106,23 +314,16 @@ def loadUrl(url,
     post_values - dictionary of the POST parameters. If None is used the
                   send protocol used would be GET
     post_values_encod - the encoding used in post_values dictionary
+    pool - HttpPool object used to send the request. If None the shared
+           module pool is used
     Returns the download content of a internet resource
     """
-    if post_values is None:
-        data = None
-    else:
-        data = urllib.parse.urlencode(post_values)
-        data = data.encode(post_values_encod)
-
-    req = Request(url, data, header)
-
-    try:
-        response = urlopen(req)
-        content = response.read()
-        resp = (200, content)
-    except HTTPError as e:
-        resp = (e.code, responses[e.code][0])
-    except BaseException as bex:
-        resp = (-1, str(bex))
-
-    return resp
+    if pool is None:
+        pool = httpPool
+
+    status, content, headers = pool.request(url, header, post_values,
+                                            post_values_encod)
+    if 200 <= status < 300:
+        status = 200
+
+    return (status, content)
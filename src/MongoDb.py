@@ -22,8 +22,11 @@
 #
 # =========================================================================
 
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import bson
 import pymongo
-from pymongo import MongoClient
+from pymongo import DeleteOne, InsertOne, MongoClient, UpdateOne
 
 __date__ = 20160418
 
@@ -33,18 +36,36 @@ class MyMongo:
                  database,
                  collection,
                  host="localhost",
-                 port=27017):
+                 port=27017,
+                 bulkSize=1000,
+                 bulkBytes=8 * 1024 * 1024,
+                 asyncWrite=False):
         """
 
         database - the mongo database name
         collection - the collection name
         host - url of the mongo server host
         port - mongo server port
+        bulkSize - the write bulk is written when it has this number of
+                   operations
+        bulkBytes - the write bulk is written when its operations have this
+                    number of BSON bytes
+        asyncWrite - if True the full write bulks are written by a
+                     background thread
         """
         self.client = MongoClient(host, port)
         self.db = self.client[database]
         self.col = self.db[collection]
-        self.bulk = self.col.initialize_unordered_bulk_op()
+
+        self.bulkSize = bulkSize
+        self.bulkBytes = bulkBytes
+        self.bulkOps = []  # operations not yet sent to the server
+        self.bulkOpsBytes = 0
+        self.bulkResults = []  # results of the writes since last bulkWrite
+        self.bulkFutures = []  # background writes not yet finished
+        self.bulkLock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1) if asyncWrite \
+            else None
 
         self.ASCENDING = pymongo.ASCENDING
         self.DESCENDING = pymongo.DESCENDING
@@ -84,6 +105,15 @@ class MyMongo:
         idd = {'_id': id_}
         return self.col.delete_one(idd).deleted_count == 1
 
+    def deleteDocs(self, ids):
+        """
+        Delete documents from the collection.
+
+        ids - list of mongo document _id fields
+        Returns the number of deleted documents
+        """
+        return self.col.delete_many({'_id': {'$in': ids}}).deleted_count
+
     def numOfDocs(self):
         """Return the number of documents of this collection."""
         return self.col.count()
@@ -146,13 +176,24 @@ class MyMongo:
         return self.col.find_one(query)
 
     def bulkClean(self):
-        """Reinitalize the write bulk."""
-        self.bulk = self.col.initialize_unordered_bulk_op()
+        """Discard the operations of the write bulk not yet written."""
+        with self.bulkLock:
+            self.bulkOps = []
+            self.bulkOpsBytes = 0
 
     def bulkWrite(self):
-        """Write documents from write bulk."""
-        self.bulk.execute()
-        self.bulkClean()
+        """
+        Write the operations of the write bulk and wait the background
+        writes.
+
+        Returns the list of pymongo BulkWriteResult of the writes (including
+        the automatic ones) since the last call
+        """
+        with self.bulkLock:
+            self.__flush(wait=True)
+            results = self.bulkResults
+            self.bulkResults = []
+        return results
 
     def bulkInsertDoc(self, doc):
         """
@@ -160,7 +201,7 @@ class MyMongo:
 
         doc - mongo document represented as a dictionary
         """
-        self.bulk.insert(doc)
+        self.__addOp(InsertOne(doc), len(bson.encode(doc)))
 
     def bulkUpdateDoc(self,
                       query,
@@ -171,7 +212,8 @@ class MyMongo:
         query - doc dictionary to find the document
         update - doc dictionary of the update part of document
         """
-        self.bulk.find(query).update_one({"$set": update})
+        self.__addOp(UpdateOne(query, {"$set": update}),
+                     len(bson.encode(query)) + len(bson.encode(update)))
 
     def bulkDeleteDoc(self,
                       query):
@@ -180,4 +222,48 @@ class MyMongo:
 
         query - doc dictionary to find the document
         """
-        self.bulk.find(query).remove_one()
+        self.__addOp(DeleteOne(query), len(bson.encode(query)))
+
+    def __addOp(self,
+                operation,
+                size):
+        """
+        Add an operation to the write bulk and write it if it is full.
+        It can be called by several threads.
+
+        operation - pymongo InsertOne, UpdateOne or DeleteOne object
+        size - BSON size of the operation documents
+        """
+        with self.bulkLock:
+            self.bulkOps.append(operation)
+            self.bulkOpsBytes += size
+            if len(self.bulkOps) >= self.bulkSize or \
+               self.bulkOpsBytes >= self.bulkBytes:
+                self.__flush(wait=False)
+
+    def __flush(self,
+                wait):
+        """
+        Send the operations of the write bulk to the server. Must be called
+        with bulkLock acquired.
+
+        wait - if True waits all background writes
+        """
+        ops = self.bulkOps
+        self.bulkOps = []
+        self.bulkOpsBytes = 0
+
+        if self.executor is None:
+            if ops:
+                self.bulkResults.append(self.col.bulk_write(ops,
+                                                            ordered=False))
+            return
+
+        if ops:
+            self.bulkFutures.append(self.executor.submit(self.col.bulk_write,
+                                                         ops, ordered=False))
+        # At most two bulks are waiting to be written.
+        while self.bulkFutures and (wait or len(self.bulkFutures) > 2 or
+                                    self.bulkFutures[0].done()):
+            # Raises the error of a failed background write
+            self.bulkResults.append(self.bulkFutures.pop(0).result())
@@ -27,10 +27,23 @@ class NLM_AOPFactory:
     def __init__(self):
         self.myMongoId = None
         self.myMongoDoc = None
+        self.myMongoLog = None
         self.xmlOutDir = None
         self.process = None
         self.owner = None
         self.encoding = "UTF-8"
+        self.eutils = None
+        self.incremental = False
+        self.fullInterval = 24
+        self.prefetch = 2
+        self.workers = 1
+        self.blockSize = (50, None, None)
+        self.rawBytes = False
+        self.checkpointFile = None
+        self.docFormat = ("xmltodict", None)
+        self.parseProcesses = (0, 100)
+        self.pipeline = None
+        self.refreshSize = 0
 
     def setMyMongoId(self, myMongoId):
         """
@@ -48,6 +61,15 @@ class NLM_AOPFactory:
         self.myMongoDoc = myMongoDoc
         return self
 
+    def setMyMongoLog(self, myMongoLog):
+        """
+
+        myMongoLog - MyMongo object representing 'log' collection (required
+                     by the incremental mode)
+        """
+        self.myMongoLog = myMongoLog
+        return self
+
     def setXmlOutDir(self, xmlOutDir):
         """
 
@@ -80,6 +102,130 @@ class NLM_AOPFactory:
         self.encoding = encoding
         return self
 
+    def setEUtils(self, eutils):
+        """
+
+        eutils - EUtils object (rate limit, tool, email, api_key) used by all
+                 E-utility requests. If not set the process wide one is used
+        """
+        self.eutils = eutils
+        return self
+
+    def setIncremental(self, incremental, fullInterval=24):
+        """
+
+        incremental - if True only the ids added or modified since the last
+                      finished harvesting are downloaded
+        fullInterval - number of hours after which a full harvesting (that
+                       also finds the no more ahead of print documents) is
+                       executed even in incremental mode
+        """
+        self.incremental = incremental
+        self.fullInterval = fullInterval
+        return self
+
+    def setPrefetch(self, prefetch):
+        """
+
+        prefetch - number of document blocks downloaded in advance while the
+                   current block is saved (0 disables the prefetching)
+        """
+        self.prefetch = prefetch
+        return self
+
+    def setWorkers(self, workers):
+        """
+
+        workers - number of document blocks downloaded at the same time
+                  (limited by the E-utilities rate limit)
+        """
+        self.workers = workers
+        return self
+
+    def setBlockSize(self, blockSize, minBlockSize=None, maxBlockSize=None):
+        """
+
+        blockSize - number of documents of each efetch request
+        minBlockSize - if present (with maxBlockSize) the block size is
+                       adapted to the efetch latency and errors
+        maxBlockSize - maximum adapted block size
+        """
+        self.blockSize = (blockSize, minBlockSize, maxBlockSize)
+        return self
+
+    def setRawBytes(self, rawBytes):
+        """
+
+        rawBytes - if True the xml files are written with the original bytes
+                   downloaded from NCBI (no parsing/serialization)
+        """
+        self.rawBytes = rawBytes
+        return self
+
+    def setCheckpointFile(self, checkpointFile):
+        """
+
+        checkpointFile - path of the file where the download state is saved
+                         to resume a broken harvesting. If None (default) no
+                         checkpoint is saved
+        """
+        self.checkpointFile = checkpointFile
+        return self
+
+    def setDocFormat(self, docFormat, projection=None):
+        """
+
+        docFormat - format of the documents saved into the 'doc' collection:
+                    'xmltodict' (default, the whole xml converted by
+                    xmltodict) or 'compact' (PubmedConverter fields)
+        projection - list of the PubmedConverter fields saved when
+                     docFormat is 'compact'. If None all fields are saved
+        """
+        if docFormat not in ["xmltodict", "compact"]:
+            raise Exception("Invalid document format: " + str(docFormat))
+        self.docFormat = (docFormat, projection)
+        return self
+
+    def setParseProcesses(self, parseProcesses, batchSize=100):
+        """
+
+        parseProcesses - number of processes used to parse the downloaded
+                         documents. If 0 (default) they are parsed by the
+                         main process, if None one process per core is used
+        batchSize - number of documents sent to a process at each time
+        """
+        self.parseProcesses = (parseProcesses, batchSize)
+        return self
+
+    def setPipeline(self, parseWorkers=1, fileWorkers=4, queueSize=1000):
+        """
+        Download, parse and save the documents in a pipeline of concurrent
+        stages (fetch -> parse -> file -> mongo) instead of one after the
+        other. The fetch stage uses the prefetch/workers/blockSize options.
+        The parse stage is only used with setRawBytes (otherwise the
+        documents are parsed by the fetch stage when they are split) and
+        not with setParseProcesses.
+
+        parseWorkers - number of threads parsing documents (rawBytes)
+        fileWorkers - number of threads writing xml files
+        queueSize - maximum number of documents waiting in front of each
+                    stage
+        """
+        self.pipeline = (parseWorkers, fileWorkers, queueSize)
+        return self
+
+    def setRefreshSize(self, refreshSize):
+        """
+
+        refreshSize - number of already saved ahead of print documents
+                      downloaded again at each harvesting (the ones checked
+                      longest ago first) to find the ones revised by NCBI.
+                      Only the documents whose content hash changed are
+                      rewritten. If 0 (default) there is no refresh
+        """
+        self.refreshSize = refreshSize
+        return self
+
     def check(self):
         """
         Check if there is a missing parameter.
@@ -95,3 +241,5 @@ class NLM_AOPFactory:
             raise Exception("process is None")
         if self.owner is None:
             raise Exception("owner is None")
+        if self.incremental and self.myMongoLog is None:
+            raise Exception("myMongoLog is None")
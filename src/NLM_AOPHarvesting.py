@@ -91,12 +91,15 @@ class NLM_AOPHarvesting(Harvesting):
                   "status": "in process"}
         query5 = {"date": dateBegin, "hour": hourBegin,
                   "status": "no_aheadofprint"}
+        query6 = {"quarantined": dateBegin + " " + hourBegin,
+                  "status": "in process"}
         totalAheadDocs = self.mid.search(query0).count()
         totalNoAheadDocs = self.mid.search(query1).count()
         totalInProcessDocs = self.mid.search(query2).count()
         newAheadDocs = self.mid.search(query3).count()
         newInProcessDocs = self.mid.search(query4).count()
         newNoAheadDocs = self.mid.search(query5).count()
+        quarantinedDocs = self.mid.search(query6).count()
 
         doc = {"_id": id_,
                "process": process, "owner": owner, "status": status,
@@ -106,6 +109,8 @@ class NLM_AOPHarvesting(Harvesting):
                "newAheadDocs": newAheadDocs,
                "newInProcessDocs": newInProcessDocs,
                "newNoAheadDocs": newNoAheadDocs,
+               "quarantinedDocs": quarantinedDocs,
+               "mode": self.ahead.mode,
                "dateBegin": dateBegin, "hourBegin": hourBegin,
                "dateEnd": dateEnd, "hourEnd": hourEnd}
 
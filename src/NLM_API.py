@@ -22,16 +22,60 @@
 #
 # =========================================================================
 
-import time
-from LoadUrl import loadUrl
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+import json
+from EUtils import getSharedEUtils
 from XML import MyXML
 
 __date__ = 20160418
 
 
 class NLM_API:
-    def __init__(self):
-        self.eutils = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+    def __init__(self,
+                 eutils=None,
+                 useJson=True):
+        """
+        Constructor.
+
+        eutils - EUtils object used to send the requests. If None the
+                 process wide one is used
+        useJson - if True esearch and einfo answers are requested in json
+                  (cheaper to parse than xml). If the json answer is not
+                  usable the xml one is requested
+        """
+        self.eutils = getSharedEUtils() if eutils is None else eutils
+        self.useJson = useJson
+
+    def __loadJson(self,
+                   utility,
+                   params,
+                   getValue):
+        """
+        Request an E-utility answer in json and extract a value from it.
+
+        utility - E-utility name, for example 'esearch.fcgi'
+        params - dictionary of the request parameters
+        getValue - function that receives the json object and returns the
+                   desired value
+        Returns the extracted value or None if json is disabled or the answer
+        is not the expected json. A failed request raises an exception (the
+        xml request would fail again after the same retries)
+        """
+        if not self.useJson:
+            return None
+
+        params = dict(params)
+        params["retmode"] = "json"
+        res = self.eutils.load(utility, params)
+        if res[0] != 200:
+            # transient errors were already retried by the EUtils retry policy
+            raise Exception("ErrCode:" + str(res[0]) + " reason:" +
+                            str(res[1]) + " utility:" + utility)
+        try:
+            return getValue(json.loads(res[1].decode("utf-8")))
+        except (ValueError, KeyError, TypeError, IndexError):
+            return None
 
     def listDatabases(self):
         """
@@ -39,9 +83,13 @@ class NLM_API:
 
         Returns a list of database names
         """
-        databases = []
+        databases = self.__loadJson("einfo.fcgi", {},
+                                    lambda js: js["einforesult"]["dblist"])
+        if databases is not None:
+            return databases
 
-        xmlRes = loadUrl(self.eutils + "/einfo.fcgi")
+        databases = []
+        xmlRes = self.eutils.load("einfo.fcgi", {})
         if xmlRes[0] == 200:
             xml = MyXML(xmlRes[1])
             xpath = xml.getXPath("eInfoResult/DbList/DbName")
@@ -58,9 +106,21 @@ class NLM_API:
         dbname - the database name
         Returns a list of field names
         """
+        def getFields(js):
+            dbInfo = js["einforesult"]["dbinfo"]
+            if isinstance(dbInfo, list):
+                dbInfo = dbInfo[0]
+            return [[fld.get("name", ""), fld.get("fullname", ""),
+                     fld.get("description", "")]
+                    for fld in dbInfo["fieldlist"]]
+
+        params = {"db": dbname, "version": "2.0"}
+        info = self.__loadJson("einfo.fcgi", params, getFields)
+        if info is not None:
+            return info
+
         info = []
-        xmlRes = loadUrl(self.eutils + "/einfo.fcgi?db=" + dbname +
-                         "&version=2.0")
+        xmlRes = self.eutils.load("einfo.fcgi", params)
 
         if xmlRes[0] == 200:
             xml = MyXML(xmlRes[1])
@@ -72,15 +132,27 @@ class NLM_API:
     def getAllIds(self,
                   dbname="pubmed",
                   query="pubstatusaheadofprint",
-                  verbose=True):
+                  verbose=True,
+                  useHistory=False,
+                  dates=None):
         """
 
         dbname - database name
         query - expression used to retrieve the document ids
+        verbose - True if some info should be printed into screen
+        useHistory - if True the search is executed only once and its result
+                     is paged from the Entrez history server (see
+                     getAllIdsHistory)
+        dates - dictionary of esearch date parameters (see getDocIds)
         Returns a pair as follows:
             (<<#ofIds>, <list with all ids retrieved from a search>)
         """
-        idTuple = self.getDocIds(dbname, query, retmax=0, verbose=verbose)
+        if useHistory:
+            idTuple = self.getAllIdsHistory(dbname, query, verbose, dates)
+            return idTuple[0], idTuple[3]
+
+        idTuple = self.getDocIds(dbname, query, retmax=0, verbose=verbose,
+                                 dates=dates)
         numOfDocs = int(idTuple[0])
 
         idList = []
@@ -91,7 +163,8 @@ class NLM_API:
             if verbose:
                 print(".", end='', flush=True)
             idTuple = self.getDocIds(dbname, query, retmax=max_,
-                                     retstart=startPos, verbose=verbose)
+                                     retstart=startPos, verbose=verbose,
+                                     dates=dates)
             idList.extend(idTuple[3])
             startPos += max_
 
@@ -100,6 +173,227 @@ class NLM_API:
 
         return numOfDocs, idList
 
+    def iterIds(self,
+                dbname="pubmed",
+                query="pubstatusaheadofprint",
+                verbose=True,
+                useHistory=False,
+                dates=None,
+                pageSize=10000):
+        """
+        Generator version of getAllIds. The ids are yielded as soon as each
+        esearch page arrives, so only one page is kept in memory.
+
+        dbname - database name
+        query - expression used to retrieve the document ids
+        verbose - True if some info should be printed into screen
+        useHistory - if True the search is executed only once and its result
+                     is paged from the Entrez history server
+        dates - dictionary of esearch date parameters (see getDocIds)
+        pageSize - number of ids retrieved by each request
+        Returns an iterator of document ids
+        """
+        if useHistory:
+            idTuple = self.getDocIds(dbname, query, useHistory=True,
+                                     verbose=verbose, dates=dates)
+            numOfDocs = int(idTuple[0])
+            ids = []
+        else:
+            # the first page also gives the number of documents
+            idTuple = self.getDocIds(dbname, query, retmax=pageSize,
+                                     verbose=verbose, dates=dates)
+            numOfDocs = int(idTuple[0])
+            ids = idTuple[3]
+        startPos = len(ids)
+
+        while True:
+            if verbose:
+                print(".", end='', flush=True)
+            yield from ids
+            if startPos >= numOfDocs:
+                break
+            if useHistory:
+                ids = self.getHistoryIds(dbname, idTuple[1], idTuple[2],
+                                         retmax=pageSize, retstart=startPos)
+            else:
+                ids = self.getDocIds(dbname, query, retmax=pageSize,
+                                     retstart=startPos, verbose=verbose,
+                                     dates=dates)[3]
+            if not ids:
+                break
+            startPos += len(ids)
+
+        if verbose:
+            print()
+
+    def getAllIdsHistory(self,
+                         dbname="pubmed",
+                         query="pubstatusaheadofprint",
+                         verbose=True,
+                         dates=None):
+        """
+        Execute the search once storing its result in the Entrez history
+        server and then page through the stored result. All pages come from
+        the same snapshot of the id set. The returned WebEnv/query_key can
+        be reused by efetch (see DocIterator).
+
+        dbname - database name
+        query - expression used to retrieve the document ids
+        verbose - True if some info should be printed into screen
+        dates - dictionary of esearch date parameters (see getDocIds)
+        Returns a tuple as follows:
+            (<#ofIds>, <webenv>, <querykey>, <list with all ids retrieved
+            from a search>)
+        """
+        idTuple = self.getDocIds(dbname, query, useHistory=True,
+                                 verbose=verbose, dates=dates)
+        numOfDocs = int(idTuple[0])
+        webEnv = idTuple[1]
+        queryKey = idTuple[2]
+
+        idList = []
+        max_ = 10000
+        startPos = 0
+
+        while startPos < numOfDocs:
+            if verbose:
+                print(".", end='', flush=True)
+            idList.extend(self.getHistoryIds(dbname, webEnv, queryKey,
+                                             retmax=max_, retstart=startPos))
+            startPos += max_
+
+        if verbose:
+            print()
+
+        return numOfDocs, webEnv, queryKey, idList
+
+    def getAllIdsByDate(self,
+                        minDate,
+                        maxDate,
+                        dbname="pubmed",
+                        query="pubstatusaheadofprint",
+                        dateType="edat",
+                        maxWorkers=4,
+                        verbose=True):
+        """
+        Retrieve the ids of a search splitting it into date windows. Windows
+        with more documents than esearch can page are recursively split in
+        two. The windows are searched concurrently (respecting the EUtils
+        rate limit) and their ids merged without duplicates.
+
+        minDate - first date (datetime.date) of the search
+        maxDate - last date (datetime.date) of the search
+        dbname - database name
+        query - expression used to retrieve the document ids
+        dateType - esearch 'datetype' ('edat', 'mdat', 'pdat', ...)
+        maxWorkers - maximum number of windows searched at the same time
+        verbose - True if some info should be printed into screen
+        Returns a pair as follows:
+            (<<#ofIds>, <list with all ids retrieved from a search>)
+        """
+        if minDate > maxDate:
+            raise Exception("minDate > maxDate")
+
+        windows = {}  # first date -> list of ids
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            pending = {executor.submit(self.__getWindowIds, dbname, query,
+                                       dateType, minDate, maxDate)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    first, ids, splits = future.result()
+                    if ids is not None:
+                        windows[first] = ids
+                        if verbose:
+                            print(".", end='', flush=True)
+                    for (begin, end) in splits:
+                        pending.add(executor.submit(self.__getWindowIds,
+                                                    dbname, query, dateType,
+                                                    begin, end))
+        if verbose:
+            print()
+
+        idList = []
+        idSet = set()
+        for first in sorted(windows):
+            for id_ in windows[first]:
+                if id_ not in idSet:
+                    idSet.add(id_)
+                    idList.append(id_)
+
+        return len(idList), idList
+
+    def __getWindowIds(self,
+                       dbname,
+                       query,
+                       dateType,
+                       minDate,
+                       maxDate):
+        """
+        Retrieve the ids of a date window or split it if it is too big. The
+        window size is checked first with retmax=0, so the ids of a window
+        that will be split are not downloaded.
+
+        Returns a tuple as follows:
+            (<minDate>, <list of ids or None if the window was split>,
+            <list of (minDate, maxDate) sub windows>)
+        """
+        max_ = 9999  # esearch can not page beyond this position
+        dates = {"datetype": dateType,
+                 "mindate": minDate.strftime("%Y/%m/%d"),
+                 "maxdate": maxDate.strftime("%Y/%m/%d")}
+
+        idTuple = self.getDocIds(dbname, query, retmax=0, verbose=False,
+                                 dates=dates)
+        numOfDocs = int(idTuple[0])
+        if numOfDocs == 0:
+            return minDate, [], []
+        if numOfDocs <= max_:
+            idTuple = self.getDocIds(dbname, query, retmax=max_,
+                                     verbose=False, dates=dates)
+            return minDate, idTuple[3], []
+
+        if minDate < maxDate:
+            middle = minDate + (maxDate - minDate) // 2
+            return minDate, None, [(minDate, middle),
+                                   (middle + timedelta(days=1), maxDate)]
+
+        # One day window can not be split. Page it from the history server.
+        idTuple = self.getAllIdsHistory(dbname, query, verbose=False,
+                                        dates=dates)
+        return minDate, idTuple[3], []
+
+    def getHistoryIds(self,
+                      dbname,
+                      webEnv,
+                      queryKey,
+                      retmax=10000,
+                      retstart=0):
+        """
+        Retrieve ids of a search result stored in the Entrez history server.
+
+        dbname - database name
+        webEnv - web environment returned by a search with useHistory
+        queryKey - query key returned by a search with useHistory
+        retmax - the maximum number of returned ids
+        retstart - initial position (from id list) used to return ids
+        Returns a list of document ids
+        """
+        if retmax > 10000:
+            raise Exception("retmax > 10.000")
+
+        params = {"db": dbname, "WebEnv": webEnv, "query_key": queryKey,
+                  "rettype": "uilist", "retmode": "text",
+                  "retstart": str(retstart), "retmax": str(retmax)}
+
+        res = self.eutils.load("efetch.fcgi", params)
+        if res[0] != 200:
+            raise Exception("ErrCode:" + str(res[0]) + " reason:" +
+                            str(res[1]) + " utility:efetch.fcgi")
+
+        return res[1].decode("ascii").split()
+
     def getDocIds(self,
                   dbname="pubmed",
                   query="pubstatusaheadofprint",
@@ -107,8 +401,8 @@ class NLM_API:
                   retstart=0,
                   field=None,
                   useHistory=False,
-                  waitSeconds=30,
-                  verbose=True):
+                  verbose=True,
+                  dates=None):
         """
 
         dbname - database name
@@ -118,9 +412,9 @@ class NLM_API:
         field - if used narrow the search to that field
         useHistory - true if the retrieved ids should the stored in the server
                      for temporary and future use by efetch.
-        waitSeconds - number of seconds the program will sleep it download
-                      fails
         verbose - True if some info should be printed into screen
+        dates - dictionary of esearch date parameters ('datetype', 'mindate',
+                'maxdate', 'reldate') used to restrict the search
         Returns a tuple as follows:
                (<#ofIds>, <webenv>, <querykey>, <list of the document ids that
                are retrieved by a query>)
@@ -128,23 +422,38 @@ class NLM_API:
         if retmax > 100000:
             raise Exception("retamax > 100.000")
 
-        url = self.eutils + "/esearch.fcgi?db=" + dbname + "&term=" + \
-              query + "&retstart=" + str(retstart)
+        params = {"db": dbname, "term": query, "retstart": str(retstart)}
 
         if useHistory:
-            url += "&usehistory=y"
+            params["usehistory"] = "y"
             retmax = 0
         if field is not None:
-            url += "&field=" + field
+            params["field"] = field
+        if dates is not None:
+            params.update(dates)
+
+        params["retmax"] = str(retmax)
 
-        url += "&retmax=" + str(retmax)
+        def getResult(js):
+            res = js["esearchresult"]
+            if "ERROR" in res:  # the xml request would fail too
+                raise Exception("ErrMsg:" + str(res["ERROR"]) +
+                                " utility:esearch.fcgi")
+            return (res["count"],
+                    res["webenv"] if useHistory else "",
+                    res["querykey"] if useHistory else "",
+                    [str(id_) for id_ in res["idlist"]] if retmax > 0 else [])
+
+        result = self.__loadJson("esearch.fcgi", params, getResult)
+        if result is not None:
+            return result
 
         count = 0
         web = ""
         key = ""
         ids = []
 
-        xmlRes = loadUrl(url)
+        xmlRes = self.eutils.load("esearch.fcgi", params)
         if xmlRes[0] == 200:
             xml = MyXML(xmlRes[1])
             count = xml.getXPath("eSearchResult/Count")[0][0]
@@ -158,15 +467,8 @@ class NLM_API:
                 for id_ in id_list:
                     ids.append(str(id_[0]))
         else:
-            if waitSeconds <= 3600:  # waits up to 1 hour and try again
-                if verbose:
-                    print("(" + str(waitSeconds) + "s)", end="",
-                          flush=True)
-                time.sleep(waitSeconds)
-                self.getDocIds(dbname, query, retmax, retstart, field,
-                               useHistory, waitSeconds * 2, verbose)
-            else:
-                raise Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
-                                xmlRes[1] + " url:" + self.url)
+            # transient errors were already retried by the EUtils retry policy
+            raise Exception("ErrCode:" + str(xmlRes[0]) + " reason:" +
+                            str(xmlRes[1]) + " utility:esearch.fcgi")
 
         return count, web, key, ids
@@ -22,12 +22,19 @@
 #
 # =========================================================================
 
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+import json
 from os.path import join
-import xmltodict
+import xml.etree.ElementTree as ET
 from NLM_API import NLM_API
 from RegularExpression import RegularExpression
 from DocIterator import DocIterator
+from XML import elementToDict
+from PubmedConverter import PubmedConverter
+from ParsePool import ParsePool
+from Pipeline import Pipeline, Stage
 import Tools
 
 __date__ = 20160418
@@ -45,34 +52,95 @@ class NLM_AheadOfPrint:
         """
         factory.check()
 
-        self.api = NLM_API()
+        self.eutils = factory.eutils
+        self.api = NLM_API(self.eutils)
         self.mid = factory.myMongoId
         self.mdoc = factory.myMongoDoc
+        self.mlog = factory.myMongoLog
         self.xmlOutDir = factory.xmlOutDir
         self.encoding = factory.encoding
         self.process_ = factory.process
         self.owner = factory.owner
+        self.incremental = factory.incremental
+        self.fullInterval = factory.fullInterval
+        self.prefetch = factory.prefetch
+        self.workers = factory.workers
+        self.blockSize = factory.blockSize
+        self.rawBytes = factory.rawBytes
+        self.checkpointFile = factory.checkpointFile
+        self.docFormat = factory.docFormat
+        self.parseProcesses = factory.parseProcesses
+        self.pipeline = factory.pipeline
+        self.refreshSize = factory.refreshSize
+        # documents between checkpoints (smaller than the 1000 ids chunks)
+        self.checkpointInterval = 100
+        self.parseExecutor = None  # worker processes of a process() run
+        if factory.docFormat[0] == "compact":
+            self.parseDoc = PubmedConverter(factory.docFormat[1]).convert
+        else:
+            self.parseDoc = elementToDict
+        self.mode = None  # 'full' or 'incremental' after process()
 
         self.mid.createIndex("id", ["id"])
         self.mid.createIndex("id_status", ["id", "status"])
         self.mid.createIndex("date_hour_status", ["date", "hour", "status"])
+        self.mid.createIndex("status", ["status"])
+        self.mid.createIndex("status_checked", ["status", "checked"])
+
+    def __getIdStatus(self,
+                      ids,
+                      chunkSize=1000):
+        """
+        Retrieve the status of the ids already saved into collection "id".
+
+        ids - a list of NLM document ids
+        chunkSize - maximum number of ids of each mongo query
+        Returns a dictionary id -> status of the saved ids
+        """
+        status = {}
+        for pos in range(0, len(ids), chunkSize):
+            query = {"id": {"$in": ids[pos:pos + chunkSize]}}
+            for doc in self.mid.search(query, ["id", "status"]):
+                status[doc["id"]] = doc["status"]
+
+        return status
+
+    def __getIdHashes(self,
+                      ids,
+                      chunkSize=1000):
+        """
+        Retrieve the content hash of the ids already saved into collection
+        "id".
+
+        ids - a list of NLM document ids
+        chunkSize - maximum number of ids of each mongo query
+        Returns a dictionary id -> hash (None if the document has no hash)
+        """
+        hashes = {}
+        for pos in range(0, len(ids), chunkSize):
+            query = {"id": {"$in": ids[pos:pos + chunkSize]}}
+            for doc in self.mid.search(query, ["id", "hash"]):
+                hashes[doc["id"]] = doc.get("hash")
+
+        return hashes
 
     def __insertDocId(self,
                       docId,
+                      status,
                       dateBegin,
                       hourBegin):
         """
         Insert an id document into collection "id".
 
         docId - NLM document id
+        status - status of the saved id document or None if it is not saved
         dateBegin - process begin date YYYYMMDD
         hourBegin - process begin time HH:MM:SS
         Returns True is it a new document False is it was already saved
         """
         # Document is new if it is not in id collection or if its status is
         # 'in process' meaning that a previous download was unfinished.
-        doc = self.mid.searchOne({"id": docId})
-        if doc is None:
+        if status is None:
             isNew = True
             doc = {"_id": docId}
             doc["id"] = docId
@@ -82,20 +150,17 @@ class NLM_AheadOfPrint:
             doc["process"] = self.process_
             doc["owner"] = self.owner
             self.mid.bulkInsertDoc(doc)  # Save document into mongo
-        else:
-            if doc["status"] is "in process":
-                isNew = True
-                fpath = join(self.xmlOutDir, docId + ".xml")
-                if Tools.existFile(fpath):
-                    try:
-                        Tools.removeFile(fpath)
-                    except OSError:
-                        raise Exception("Document id:" + str(docId) +
-                                        " deletion failed")
-                self.mdoc.deleteDoc(docId)
-
-            else:  # aheadofprint, no_aheadofprint
-                isNew = False
+        elif status == "in process":
+            isNew = True
+            fpath = join(self.xmlOutDir, docId + ".xml")
+            if Tools.existFile(fpath):
+                try:
+                    Tools.removeFile(fpath)
+                except OSError:
+                    raise Exception("Document id:" + str(docId) +
+                                    " deletion failed")
+        else:  # aheadofprint, no_aheadofprint
+            isNew = False
 
         return isNew
 
@@ -103,7 +168,8 @@ class NLM_AheadOfPrint:
                     ids,
                     dateBegin,
                     hourBegin,
-                    verbose=False):
+                    verbose=False,
+                    knownIds=None):
         """
         For each id from a list of ids, adds a new id document into mongo id
         collection.
@@ -112,29 +178,37 @@ class NLM_AheadOfPrint:
         dateBegin - process begin date YYYYMMDD
         hourBegin - process begin time HH:MM:SS
         verbose - if True prints the document is inserted
+        knownIds - if not None, list where the ids already saved with
+                   'aheadofprint' status are appended
         Returns a list of ids that are new to the collection 'id'
         """
         newDocs = []
+        inProcess = []
         id_size = len(ids)
         # print("dateBegin=" + dateBegin)
         if verbose:
             print("Checking " + str(id_size) + " documents: ",
                   end='', flush=True)
 
+        # One query per chunk of ids instead of one query per id.
+        idStatus = self.__getIdStatus(ids)
+
         bulkCount = 0
         notWrittenDocs = 0
-        bulkRemaining = False
         # print("\nNumero de ids baixados: " + str(id_size))
         for id_ in ids:
             # Insert id document into collection "id"
-            isNewDoc = self.__insertDocId(id_, dateBegin, hourBegin)
+            status = idStatus.get(id_)
+            if knownIds is not None and status == "aheadofprint":
+                knownIds.append(id_)
+            isNewDoc = self.__insertDocId(id_, status, dateBegin, hourBegin)
+            # a repeated id is checked only once
+            idStatus[id_] = "checked"
             if isNewDoc:
                 newDocs.append(id_)
+                if status is not None:
+                    inProcess.append(id_)
                 bulkCount += 1
-                bulkRemaining = True
-                if bulkCount % 100 == 0:
-                    self.mid.bulkWrite()
-                    bulkRemaining = False
             else:
                 notWrittenDocs += 1
 
@@ -142,10 +216,13 @@ class NLM_AheadOfPrint:
                 ch = '+' if isNewDoc else '.'
                 print(ch, end='', flush=True)
 
-        # Write remaining
-        if bulkRemaining:
+        # Write remaining ('in process' ids add nothing to the bulk)
+        if len(newDocs) > len(inProcess):
             self.mid.bulkWrite()
-            bulkRemaining = False
+
+        # Remove the documents of unfinished downloads
+        if inProcess:
+            self.mdoc.deleteDocs(inProcess)
 
         if (bulkCount + notWrittenDocs) != id_size:
             raise Exception("__insertDocs: some doc ids were not written")
@@ -158,7 +235,10 @@ class NLM_AheadOfPrint:
                             hourBegin,
                             xdir=".",
                             encoding="UTF-8",
-                            verbose=False):
+                            verbose=False,
+                            startPos=0,
+                            webEnv=None,
+                            queryKey=None):
         """
         For each id from a list of ids, add a new document into mongo xml
         collection and creates a new file with xml content.
@@ -169,60 +249,256 @@ class NLM_AheadOfPrint:
         xdir - output file directory
         encoding - output file encoding
         verbose - if True prints the document is inserted
+        startPos - position (in newDocs) of the first document to be
+                   downloaded (used to resume from a checkpoint)
+        webEnv - history server WebEnv of newDocs (used to resume)
+        queryKey - history server query_key of newDocs (used to resume)
         """
 
-        newDocLen = len(newDocs)
+        newDocLen = len(newDocs) - startPos
         # print("\nNumero de ids novos: " + str(newDocLen))
         if newDocLen > 0:
             if verbose:
                 print("\nDownloading and saving " + str(newDocLen) +
                       " documents: ", end='', flush=True)
-            diter = DocIterator(newDocs, verbose=verbose)
+            usePool = self.parseProcesses[0] != 0
+            # The documents are parsed by the DocIterator while they are
+            # split, except by other processes or by the pipeline parse
+            # stage (rawBytes, the split does not parse them).
+            parseInFetch = not usePool and \
+                (self.pipeline is None or not self.rawBytes)
+            checked = dateBegin + " " + hourBegin  # last content check
+            diter = DocIterator(newDocs, verbose=verbose, eutils=self.eutils,
+                                startPos=startPos, webEnv=webEnv,
+                                queryKey=queryKey,
+                                prefetch=self.prefetch, workers=self.workers,
+                                blockSize=self.blockSize[0],
+                                minBlockSize=self.blockSize[1],
+                                maxBlockSize=self.blockSize[2],
+                                rawBytes=self.rawBytes,
+                                parseDoc=self.parseDoc if parseInFetch
+                                else None)
+            if usePool:  # the documents are parsed by other processes
+                diter = ParsePool(diter, self.parseProcesses[0],
+                                  self.docFormat[0], self.docFormat[1],
+                                  self.parseProcesses[1],
+                                  executor=self.parseExecutor)
 
             bulkCount = 0
-            bulkRemaining = False
-
-            for dId in diter:
-                docId = dId[0]
-                xml = dId[1]
 
-                # Save xml content into mongo and file
-                Tools.xmlToFile(docId, xml, xdir, encoding)  # save into file
-                docDict = xmltodict.parse(xml)
-                doc = {"_id": docId, "doc": docDict}
-                self.mdoc.bulkInsertDoc(doc)  # save into mongo 'doc' coll
-
-                # Change document document status from 'in process' to
-                # 'aheadofprint' in id collection.
-                self.mid.bulkUpdateDoc({"id": docId},
-                                       {"status": "aheadofprint"})
-
-                bulkRemaining = True
-                bulkCount += 1
-                if bulkCount % 100 == 0:
-                    self.mid.bulkWrite()
-                    self.mdoc.bulkWrite()
-                    bulkRemaining = False
+            try:
+                if self.pipeline is not None:
+                    bulkCount = self.__runPipeline(diter, usePool, checked,
+                                                   xdir, encoding, verbose)
+                else:
+                    for dId in diter:
+                        docId = dId[0]
+                        xml = dId[1]
+                        if usePool:
+                            doc = dId[2]
+                        else:  # xmltodict structure or compact doc
+                            doc = {"_id": docId, "doc": dId[2]}
+
+                        # Save xml content into mongo and file
+                        Tools.xmlToFile(docId, xml, xdir, encoding)
+                        self.mdoc.bulkInsertDoc(doc)  # into 'doc' collection
+
+                        # Change document document status from 'in process'
+                        # to 'aheadofprint' in id collection.
+                        self.mid.bulkUpdateDoc({"id": docId},
+                                               {"status": "aheadofprint",
+                                                "hash": Tools.contentHash(xml),
+                                                "checked": checked})
+
+                        bulkCount += 1
+                        if self.checkpointFile is not None and \
+                           bulkCount % self.checkpointInterval == 0:
+                            self.mid.bulkWrite()
+                            self.mdoc.bulkWrite()
+                            self.__saveCheckpoint(diter)
+            finally:
+                diter.close()  # stops the download threads on errors
 
             # Write remaining
-            if bulkRemaining:
+            self.mid.bulkWrite()
+            self.mdoc.bulkWrite()
+
+            # Documents that NCBI did not return (for example withdrawn
+            # ones) keep the 'in process' status and are tried again in the
+            # next harvesting. The time of the failure is kept in the
+            # 'quarantined' field.
+            badIds = diter.getQuarantine()
+            if badIds:
+                for docId in badIds:
+                    self.mid.bulkUpdateDoc({"id": docId},
+                                           {"quarantined": checked})
                 self.mid.bulkWrite()
-                self.mdoc.bulkWrite()
+                if verbose:
+                    print("\nDocuments not downloaded: " + ",".join(badIds),
+                          end='', flush=True)
 
-            if bulkCount != newDocLen:
+            if bulkCount + len(badIds) != newDocLen:
                 raise Exception("__insertDocs: some new docs were not written")
+            self.__removeCheckpoint()
 
             # print("\nDocumentos escritos: " + str(bulkCount))
             if verbose:
                 print()  # to print a new line
 
+    def __runPipeline(self,
+                      diter,
+                      usePool,
+                      checked,
+                      xdir,
+                      encoding,
+                      verbose=False):
+        """
+        Save the downloaded documents into files and mongo with a pipeline
+        of concurrent stages: fetch (DocIterator) -> parse -> file -> mongo.
+        The parse stage is only used with rawBytes, otherwise the documents
+        are already parsed by the DocIterator (single parse) or ParsePool.
+
+        diter - DocIterator or ParsePool object
+        usePool - True if diter is a ParsePool
+        checked - date and hour of the content check of the documents
+        xdir - output file directory
+        encoding - output file encoding
+        verbose - if True prints the statistics of each stage
+        Returns the number of saved documents
+        """
+        parseWorkers, fileWorkers, queueSize = self.pipeline
+        parseStage = not usePool and self.rawBytes
+
+        def source():
+            # Items are (<seq>, <position after the document>, <id>, <xml>,
+            # <mongo document or None if parseStage>).
+            for seq, dId in enumerate(diter):
+                if usePool:
+                    doc = dId[2]
+                elif parseStage:
+                    doc = None
+                else:
+                    doc = {"_id": dId[0], "doc": dId[2]}
+                yield (seq, diter.getPosition(), dId[0], dId[1], doc)
+
+        def parse(item):
+            xml = item[3]
+            elem = ET.fromstring(xml if isinstance(xml, str) else bytes(xml))
+            return item[:4] + ({"_id": item[2], "doc": self.parseDoc(elem)},)
+
+        def saveFile(item):
+            Tools.xmlToFile(item[2], item[3], xdir, encoding)
+            return item
+
+        # The file stage can change the order of the documents, so the
+        # checkpoint position is the one after the last document whose
+        # predecessors are all saved.
+        state = {"count": 0, "nextSeq": 0, "position": diter.getPosition()}
+        done = {}  # seq -> position of saved documents after nextSeq
+
+        def flush():
+            self.mid.bulkWrite()
+            self.mdoc.bulkWrite()
+            while state["nextSeq"] in done:
+                state["position"] = done.pop(state["nextSeq"])
+                state["nextSeq"] += 1
+            self.__saveCheckpoint(diter, state["position"])
+
+        def saveMongo(item):
+            self.mdoc.bulkInsertDoc(item[4])
+            self.mid.bulkUpdateDoc({"id": item[2]},
+                                   {"status": "aheadofprint",
+                                    "hash": Tools.contentHash(item[3]),
+                                    "checked": checked})
+            done[item[0]] = item[1]
+            state["count"] += 1
+            if self.checkpointFile is not None and \
+               state["count"] % self.checkpointInterval == 0:
+                flush()
+
+        def finish():
+            flush()  # write remaining
+
+        stages = [Stage("parse", parse, parseWorkers)] if parseStage else []
+        stages.append(Stage("file", saveFile, fileWorkers))
+        stages.append(Stage("mongo", saveMongo, 1, finish))
+        stats = Pipeline(source(), stages, "fetch", queueSize).run()
+
+        if verbose:
+            print()
+            for stat in stats:
+                print(stat["stage"] + ": " + str(stat["items"]) +
+                      " documents, " + ("-" if stat["rate"] is None else
+                                        "{0:.1f}".format(stat["rate"])) +
+                      " docs/s, usage " + ("-" if stat["usage"] is None else
+                                           "{0:.0%}".format(stat["usage"])),
+                      flush=True)
+
+        return state["count"]
+
+    def __saveCheckpoint(self,
+                         diter,
+                         position=None):
+        """
+        Save the state of a download whose documents before the current
+        position are already written into mongo and files.
+
+        diter - the DocIterator (or ParsePool) object of the download
+        position - position of the first document not saved. If None the
+                   diter current position
+        """
+        if self.checkpointFile is not None:
+            checkpoint = diter.getCheckpoint()
+            if position is not None:
+                checkpoint["position"] = position
+            Tools.writeFile(self.checkpointFile, json.dumps(checkpoint))
+
+    def __removeCheckpoint(self):
+        """Remove the checkpoint of a finished download."""
+        if self.checkpointFile is not None and \
+           Tools.existFile(self.checkpointFile):
+            Tools.removeFile(self.checkpointFile)
+
+    def __resumeCheckpoint(self,
+                           dateBegin,
+                           hourBegin,
+                           verbose=False):
+        """
+        Finish a download broken by a previous harvesting, starting from the
+        last saved checkpoint.
+
+        dateBegin - process begin date YYYYMMDD
+        hourBegin - process begin time HH:MM:SS
+        verbose - if True prints the document is inserted
+        """
+        if self.checkpointFile is None or \
+           not Tools.existFile(self.checkpointFile):
+            return
+
+        checkpoint = json.loads(Tools.readFile(self.checkpointFile))
+        ids = checkpoint["ids"]
+        position = checkpoint["position"]
+        if verbose:
+            print("\nResuming broken download from document " +
+                  str(position + 1) + "/" + str(len(ids)), flush=True)
+
+        # Documents after the checkpoint may be partially written
+        self.mdoc.deleteDocs(ids[position:])
+        if position < len(ids):
+            self.__insertDocContents(ids, dateBegin, hourBegin,
+                                     self.xmlOutDir, self.encoding, verbose,
+                                     position, checkpoint["webEnv"],
+                                     checkpoint["queryKey"])
+        self.__removeCheckpoint()
+
     def __insertDocs(self,
                      ids,
                      dateBegin,
                      hourBegin,
                      xdir=".",
                      encoding="UTF-8",
-                     verbose=False):
+                     verbose=False,
+                     knownIds=None):
         """
         For each id from a list of ids, adds a new id document into mongo id
         collection, add a new document into mongo xml collection and creates a
@@ -234,8 +510,11 @@ class NLM_AheadOfPrint:
         xdir - output file directory
         encoding - output file encoding
         verbose - if True prints the document is inserted
+        knownIds - if not None, list where the ids already saved with
+                   'aheadofprint' status are appended
         """
-        newDocs = self.__insertIds(ids, dateBegin, hourBegin, verbose)
+        newDocs = self.__insertIds(ids, dateBegin, hourBegin, verbose,
+                                   knownIds)
         self.__insertDocContents(newDocs, dateBegin, hourBegin, xdir,
                                  encoding, verbose)
 
@@ -250,46 +529,151 @@ class NLM_AheadOfPrint:
                           ids,
                           dateBegin,
                           hourBegin,
-                          verbose=False):
+                          verbose=False,
+                          chunkSize=1000,
+                          maxWorkers=8):
         """
         Change the document status from "aheadofprint" to
         "no_aheadofprint" if MongoDb lastHarvesting document field is not
         in the ids list.
-        ids - list of aheadofprint document ids
+        ids - set of aheadofprint document ids
         dateBegin - process begin date YYYYMMDD
         hourBegin - process begin time HH:MM:SS
         verbose - if True prints document id into standard output
+        chunkSize - number of documents removed by each bulk operation
+        maxWorkers - number of files deleted at the same time
         """
-        # Searches all documents in the 'doc' collection that belongs to the
-        # ids list. If document is not in the list and is aheadofprint,
-        # delete it.
-        query = {"id": {"$nin": ids}, "status": "aheadofprint"}
-        cursor = self.mid.search(query)
-        tot = cursor.count()
-
-        for oldDoc in cursor:
-            id_ = oldDoc["id"]
-            # Deletes the xml physical file
-            fpath = join(self.xmlOutDir, id_ + ".xml")
+        # The ids that are no more ahead of print are computed here (set
+        # difference) instead of sending all ids into a $nin query.
+        ids = set(ids)
+        cursor = self.mid.search({"status": "aheadofprint"}, ["id"])
+        oldIds = [doc["id"] for doc in cursor if doc["id"] not in ids]
+        tot = len(oldIds)
+
+        def removeFile(id_):
+            # Returns the error or None if the file was removed (or it was
+            # already removed by a previous broken harvesting).
             try:
-                Tools.removeFile(fpath)
-            except OSError:
-                raise Exception("Remove file [" + str(fpath) + "] error")
+                Tools.removeFile(join(self.xmlOutDir, id_ + ".xml"))
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                return ex
+            return None
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            for pos in range(0, tot, chunkSize):
+                chunk = oldIds[pos:pos + chunkSize]
+
+                # Deletes the xml physical files
+                errors = list(executor.map(removeFile, chunk))
+                removed = [id_ for id_, err in zip(chunk, errors)
+                           if err is None]
+
+                # Deletes documents from 'doc' collection
+                if removed:
+                    self.mdoc.deleteDocs(removed)
+
+                # Update id mongo docs
+                for id_ in removed:
+                    self.mid.bulkUpdateDoc({"id": id_},
+                                           {"date": dateBegin,
+                                            "hour": hourBegin,
+                                            "status": "no_aheadofprint",
+                                            "process": self.process_,
+                                            "owner": self.owner})
+
+                failed = [err for err in errors if err is not None]
+                if failed:
+                    self.mid.bulkWrite()  # status of the removed ones
+                    raise Exception("Remove file [" +
+                                    str(failed[0].filename) + "] error")
+        self.mid.bulkWrite()
+        if verbose:
+            print("Total: " + str(tot) + " xml files were deleted.")
+
+    def __refreshDocs(self,
+                      dateBegin,
+                      hourBegin,
+                      verbose=False):
+        """
+        Download again the 'refreshSize' ahead of print documents checked
+        longest ago and rewrite the file and the mongo document of the ones
+        whose content hash changed (revised by NCBI). The unchanged ones only
+        get their check date updated.
 
-            # Deletes document from 'doc' collection
-            self.mdoc.deleteDoc(id_)
+        dateBegin - process begin date YYYYMMDD
+        hourBegin - process begin time HH:MM:SS
+        verbose - if True prints the number of changed documents
+        """
+        checked = dateBegin + " " + hourBegin
+        query = {"status": "aheadofprint", "checked": {"$ne": checked}}
+        cursor = self.mid.search(query, ["id", "hash"]).sort(
+            "checked", self.mid.ASCENDING).limit(self.refreshSize)
+        hashes = {doc["id"]: doc.get("hash") for doc in cursor}
+        if verbose and hashes:
+            print("\nRefreshing " + str(len(hashes)) + " documents: ",
+                  end='', flush=True)
+        self.__rewriteDocs(hashes, dateBegin, hourBegin, verbose)
+
+    def __rewriteDocs(self,
+                      hashes,
+                      dateBegin,
+                      hourBegin,
+                      verbose=False):
+        """
+        Download again a set of ahead of print documents and rewrite the file
+        and the mongo document of the ones whose content hash changed. All of
+        them get their check date updated.
+
+        hashes - dictionary id -> content hash saved into collection "id"
+        dateBegin - process begin date YYYYMMDD
+        hourBegin - process begin time HH:MM:SS
+        verbose - if True prints the number of changed documents
+        """
+        if not hashes:
+            return
+        checked = dateBegin + " " + hourBegin
+
+        diter = DocIterator(list(hashes), verbose=verbose,
+                            eutils=self.eutils,
+                            prefetch=self.prefetch, workers=self.workers,
+                            blockSize=self.blockSize[0],
+                            minBlockSize=self.blockSize[1],
+                            maxBlockSize=self.blockSize[2],
+                            rawBytes=self.rawBytes,
+                            parseDoc=self.parseDoc)
+        count = 0
+        changed = 0
+
+        try:
+            for docId, xml, docDict in diter:
+                hash_ = Tools.contentHash(xml)
+                update = {"checked": checked}
+                if hash_ != hashes[docId]:
+                    Tools.xmlToFile(docId, xml, self.xmlOutDir, self.encoding)
+                    self.mdoc.bulkUpdateDoc({"_id": docId}, {"doc": docDict})
+                    update["hash"] = hash_
+                    update["date"] = dateBegin
+                    update["hour"] = hourBegin
+                    changed += 1
+                self.mid.bulkUpdateDoc({"id": docId}, update)
+                count += 1
+        finally:
+            diter.close()
+
+        # Documents not returned (for example withdrawn ones) are also
+        # marked as checked, so the next refresh does not start by them.
+        for docId in diter.getQuarantine():
+            self.mid.bulkUpdateDoc({"id": docId}, {"checked": checked})
+
+        # Write remaining
+        self.mid.bulkWrite()
+        self.mdoc.bulkWrite()
 
-            # Update id mongo doc
-            doc = {"_id": oldDoc["_id"]}
-            doc["id"] = id_
-            doc["date"] = dateBegin
-            doc["hour"] = hourBegin
-            doc["status"] = "no_aheadofprint"
-            doc["process"] = self.process_
-            doc["owner"] = self.owner
-            self.mid.replaceDoc(doc)
         if verbose:
-            print("Total: " + str(tot) + " xml files were deleted.")
+            print("\nTotal: " + str(changed) + " of " + str(count) +
+                  " refreshed documents were changed.", flush=True)
 
     def __getDocIdList(self,
                        filePath,
@@ -307,6 +691,48 @@ class NLM_AheadOfPrint:
 
         return rex.findAll(xml)
 
+    def __getLastHarvest(self,
+                         fullOnly=False):
+        """
+
+        fullOnly - if True only full harvestings are considered
+        Returns the begin datetime of the last finished harvesting or None if
+        there is no one
+        """
+        query = {"process": self.process_ + "_harvesting",
+                 "status": "finished"}
+        if fullOnly:
+            # documents written before the incremental mode have no 'mode'
+            query["mode"] = {"$ne": "incremental"}
+        cursor = self.mlog.search(query).sort("_id", self.mlog.DESCENDING)
+
+        for doc in cursor.limit(1):
+            return datetime.strptime(doc["dateBegin"] + " " + doc["hourBegin"],
+                                     "%Y%m%d %H:%M:%S")
+        return None
+
+    def __iterChangedIds(self,
+                         since,
+                         verbose=True):
+        """
+        Retrieve the ahead of print ids added (entrez date) or modified
+        (modification date) since a given date.
+
+        since - datetime from which the changes are searched
+        verbose - True if processing progress should be printed into standard
+                  output
+        Returns an iterator of document ids
+        """
+        idSet = set()
+        for dateType in ["edat", "mdat"]:
+            dates = {"datetype": dateType,
+                     "mindate": since.strftime("%Y/%m/%d"),
+                     "maxdate": datetime.now().strftime("%Y/%m/%d")}
+            for id_ in self.api.iterIds(verbose=verbose, dates=dates):
+                if id_ not in idSet:
+                    idSet.add(id_)
+                    yield id_
+
     def process(self,
                 dateBegin,
                 hourBegin,
@@ -315,6 +741,29 @@ class NLM_AheadOfPrint:
         Download 'ahead of print' xlm documents and saves then into mongo
                   and files.
 
+        dateBegin - process begin date YYYYMMDD
+        hourBegin - process begin time HH:MM:SS
+        verbose - True if processing progress should be printed into standard
+                  output
+        """
+        # The parse processes are shared by all the downloaded id chunks.
+        if self.parseProcesses[0] != 0:
+            self.parseExecutor = ProcessPoolExecutor(
+                max_workers=self.parseProcesses[0])
+        try:
+            self.__process(dateBegin, hourBegin, verbose)
+        finally:
+            if self.parseExecutor is not None:
+                self.parseExecutor.shutdown()
+                self.parseExecutor = None
+
+    def __process(self,
+                  dateBegin,
+                  hourBegin,
+                  verbose=True):
+        """
+        See process().
+
         dateBegin - process begin date YYYYMMDD
         hourBegin - process begin time HH:MM:SS
         verbose - True if processing progress should be printed into standard
@@ -322,36 +771,79 @@ class NLM_AheadOfPrint:
         """
         nowDate = datetime.now()
 
-        # Retrive all ahead of print document ids
+        # In incremental mode only the ids added or modified since the last
+        # harvesting are retrieved. A periodic full harvesting is still
+        # required to find the documents that are no more ahead of print.
+        since = None
+        if self.incremental:
+            lastFull = self.__getLastHarvest(fullOnly=True)
+            if lastFull is not None and (nowDate - lastFull) < \
+               timedelta(hours=self.fullInterval):
+                since = self.__getLastHarvest()
+        self.mode = "full" if since is None else "incremental"
+
+        # Finish the download broken by a previous harvesting
+        self.__resumeCheckpoint(dateBegin, hourBegin, verbose)
+
+        # Retrive ahead of print document ids. Each block of ids is
+        # checked and downloaded as soon as it is retrieved.
         if verbose:
-            print("\nRetrieving document ids: ", end='')
+            if since is None:
+                print("\nRetrieving ahead of print documents.", flush=True)
+            else:
+                print("\nRetrieving ahead of print documents added or " +
+                      "modified since " + str(since) + ".", flush=True)
+
+        if since is None:
+            idIter = self.api.iterIds(verbose=False)
+        else:
+            idIter = self.__iterChangedIds(since, verbose=False)
+
+        # Insert new ahead of print documents
+        idSet = set()  # all ahead of print ids (only in the full mode)
+        # ids already saved (only in the incremental mode). The modified
+        # ones must be downloaded again.
+        knownIds = None if since is None else []
+        numOfDocs = 0
+        loop = 1000  # 10000
+
+        while True:
+            ids = list(islice(idIter, loop))
+            if not ids:
+                break
+            if verbose:
+                print("\n" + str(numOfDocs + 1) + "-" +
+                      str(numOfDocs + len(ids)))
 
-        idTuple = self.api.getAllIds()
-        numOfDocs = int(idTuple[0])
-        idList = idTuple[1]
+            self.__insertDocs(ids, dateBegin, hourBegin,
+                              self.xmlOutDir, self.encoding, verbose,
+                              knownIds)
+            numOfDocs += len(ids)
+            if since is None:
+                idSet.update(ids)
 
         if verbose:
-            print("Total: " + str(numOfDocs) + " ahead of print documents.",
+            print("\nTotal: " + str(numOfDocs) + " ahead of print documents.",
                   flush=True)
 
         # Remove no more ahead of print documents
-        if verbose:
-            print("\nRemoving no ahead of print documents.", flush=True)
-        self.__changeDocStatus(idList, dateBegin, hourBegin, verbose)
-
-        # Insert new ahead of print documents
-        from_ = 0
-        loop = 1000  # 10000
-
-        while from_ < numOfDocs:
+        if since is None:
             if verbose:
-                print("\n" + str(from_+1) + "/" + str(numOfDocs))
+                print("\nRemoving no ahead of print documents.", flush=True)
+            self.__changeDocStatus(idSet, dateBegin, hourBegin, verbose)
 
-            to = from_ + loop
-            self.__insertDocs(idList[from_:to],
-                              dateBegin, hourBegin,
-                              self.xmlOutDir, self.encoding, verbose)
-            from_ += loop
+        # Rewrite the already saved documents modified since the last
+        # harvesting
+        if knownIds:
+            if verbose:
+                print("\nChecking " + str(len(knownIds)) +
+                      " modified documents: ", end='', flush=True)
+            self.__rewriteDocs(self.__getIdHashes(knownIds), dateBegin,
+                               hourBegin, verbose)
+
+        # Rewrite the documents revised by NCBI
+        if self.refreshSize > 0:
+            self.__refreshDocs(dateBegin, hourBegin, verbose)
 
         if verbose:
             elapsedTime = datetime.now() - nowDate
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import xml.etree.ElementTree as ET
+
+from PubmedConverter import PubmedConverter
+from XML import elementToDict
+
+__date__ = 20261018
+
+parsers = {}  # parse functions already created in the worker process
+
+
+def getParser(docFormat,
+              projection):
+    """
+
+    docFormat - 'xmltodict' or 'compact'
+    projection - tuple of PubmedConverter fields or None
+    Returns the function that converts a xml element into the 'doc' field
+    """
+    parser = parsers.get((docFormat, projection))
+    if parser is None:
+        if docFormat == "compact":
+            parser = PubmedConverter(projection).convert
+        else:
+            parser = elementToDict
+        parsers[(docFormat, projection)] = parser
+    return parser
+
+
+def parseBatch(batch,
+               docFormat,
+               projection):
+    """
+    Worker process function.
+
+    batch - list of pairs (<id>, <xml document as str or bytes>)
+    docFormat - 'xmltodict' or 'compact'
+    projection - tuple of PubmedConverter fields or None
+    Returns the list of mongo documents of the batch, in the same order
+    """
+    parse = getParser(docFormat, projection)
+
+    return [{"_id": docId, "doc": parse(ET.fromstring(xml))}
+            for docId, xml in batch]
+
+
+class ParsePool:
+    """
+    Parse the documents of a DocIterator in a pool of processes, so the xml
+    conversion uses all cores instead of competing with the downloads for
+    the GIL. The documents are sent to the processes in batches and returned
+    in the original order.
+    """
+
+    def __init__(self,
+                 docIter,
+                 processes=None,
+                 docFormat="xmltodict",
+                 projection=None,
+                 batchSize=100,
+                 maxPending=None,
+                 executor=None):
+        """
+        Constructor.
+
+        docIter - DocIterator object returning pairs (<id>, <xml document>)
+                  (parseDoc=None)
+        processes - number of worker processes. If None the number of cores
+        docFormat - format of the parsed documents: 'xmltodict' or 'compact'
+        projection - list of the PubmedConverter fields if docFormat is
+                     'compact'
+        batchSize - number of documents sent to a process at each time
+        maxPending - maximum number of batches being parsed or waiting to be
+                     consumed (the DocIterator is not read while this limit
+                     is reached). If None twice the number of processes
+        executor - ProcessPoolExecutor shared by several ParsePool objects,
+                   so the worker processes are not started again for each
+                   one. It is not shut down by close(). If None a new one
+                   with 'processes' workers is used
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.docIter = docIter
+        self.docFormat = docFormat
+        self.projection = None if projection is None else tuple(projection)
+        self.batchSize = max(1, batchSize)
+        self.maxPending = maxPending or 2 * processes
+        self.ownExecutor = executor is None
+        self.executor = ProcessPoolExecutor(max_workers=processes) \
+            if executor is None else executor
+        self.pending = deque()  # pairs (<batch items>, <future>)
+        self.ready = deque()
+        self.exhausted = False
+        # position (in ids) of the document after the last returned one
+        self.position = docIter.getPosition()
+
+    def __iter__(self):
+        """Turn this class iterable."""
+        return self
+
+    def __next__(self):
+        """
+        Return the next tuple (<id>, <downloaded xml document>, <mongo
+        document>).
+        """
+        while not self.ready:
+            self.__submitBatches()
+            if not self.pending:
+                self.close()
+                raise StopIteration
+            items, future = self.pending.popleft()
+            for item, doc in zip(items, future.result()):
+                self.ready.append(item + (doc,))
+
+        docId, xml, position, doc = self.ready.popleft()
+        self.position = position
+
+        return docId, xml, doc
+
+    def close(self):
+        """Stop the downloads and the worker processes (if not shared)."""
+        self.docIter.close()
+        if self.ownExecutor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            for _, future in self.pending:
+                future.cancel()
+            self.pending.clear()
+
+    def getQuarantine(self):
+        """
+        Return the ids whose documents could not be downloaded (see
+        DocIterator.getQuarantine).
+        """
+        return self.docIter.getQuarantine()
+
+    def getPosition(self):
+        """
+        Return the position (in ids) of the next document to be returned
+        by this pool (see DocIterator.getPosition).
+        """
+        return self.position
+
+    def getCheckpoint(self):
+        """
+        Return the DocIterator checkpoint (see DocIterator.getCheckpoint)
+        with the position of the next document to be returned by this pool,
+        which is behind the DocIterator one.
+        """
+        checkpoint = self.docIter.getCheckpoint()
+        checkpoint["position"] = self.position
+
+        return checkpoint
+
+    def __submitBatches(self):
+        """Read the DocIterator and send batches until maxPending."""
+        while not self.exhausted and len(self.pending) < self.maxPending:
+            items = []
+            batch = []
+            for docId, xml in self.docIter:
+                items.append((docId, xml, self.docIter.getPosition()))
+                # memoryview (rawBytes) can not be pickled
+                batch.append((docId, xml if isinstance(xml, str)
+                              else bytes(xml)))
+                if len(batch) >= self.batchSize:
+                    break
+            else:
+                self.exhausted = True
+            if batch:
+                self.pending.append((items, self.executor.submit(
+                    parseBatch, batch, self.docFormat, self.projection)))
@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+from queue import Empty, Full, Queue
+import threading
+import time
+
+__date__ = 20261018
+
+END = object()  # end of the stream of items
+
+
+class Stage:
+    """
+    A step of a Pipeline: a function applied to each item by one or more
+    threads.
+    """
+
+    def __init__(self,
+                 name,
+                 function,
+                 workers=1,
+                 finish=None):
+        """
+        Constructor.
+
+        name - stage name (used in the statistics)
+        function - function that receives an item and returns the item
+                   passed to the next stage (None to drop it)
+        workers - number of threads running the function
+        finish - function without parameters called after the last item
+                 (for example to flush a buffer). It is not called on errors
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.finish = finish
+        self.items = 0
+        self.busy = 0.0  # seconds spent inside the function (all threads)
+        self.lock = threading.Lock()
+
+    def addTime(self,
+                seconds):
+        """
+        Account one processed item.
+
+        seconds - time spent processing the item
+        """
+        with self.lock:
+            self.items += 1
+            self.busy += seconds
+
+
+class Pipeline:
+    """
+    Run a source iterator and a sequence of stages concurrently. The stages
+    are connected by bounded queues, so a slow stage blocks the previous
+    ones instead of accumulating items in memory, and the pipeline goes as
+    fast as its slowest stage instead of the sum of all of them.
+    """
+
+    def __init__(self,
+                 source,
+                 stages,
+                 sourceName="source",
+                 queueSize=100):
+        """
+        Constructor.
+
+        source - iterable that produces the items of the first stage
+        stages - list of Stage objects
+        sourceName - name of the source in the statistics
+        queueSize - maximum number of items waiting in front of each stage
+        """
+        self.source = source
+        self.sourceStage = Stage(sourceName, None)
+        self.stages = stages
+        self.queueSize = queueSize
+        self.stopEvent = threading.Event()
+        self.errors = []
+        self.elapsed = 0.0
+
+    def run(self):
+        """
+        Process all source items. If a stage raises an exception, the whole
+        pipeline is stopped and the exception is raised again here.
+
+        Returns the statistics (see getStats)
+        """
+        queues = [Queue(maxsize=self.queueSize) for _ in self.stages]
+        threads = [threading.Thread(target=self.__readSource,
+                                    args=(queues[0] if queues else None,))]
+        for idx, stage in enumerate(self.stages):
+            outQueue = queues[idx + 1] if idx + 1 < len(queues) else None
+            running = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self.__runStage,
+                    args=(stage, queues[idx], outQueue, running)))
+
+        begin = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - begin
+
+        if self.errors:
+            raise self.errors[0]
+
+        return self.getStats()
+
+    def getStats(self):
+        """
+        Return a list with a dictionary for the source and each stage with
+        the fields: stage (name), workers, items, busy (seconds spent in the
+        stage function), rate (items per second the stage can process, the
+        lowest one is the bottleneck) and usage (fraction of the elapsed time
+        the stage threads were busy).
+        """
+        stats = []
+        for stage in [self.sourceStage] + self.stages:
+            rate = stage.items * stage.workers / stage.busy \
+                if stage.busy > 0 else None
+            usage = stage.busy / (stage.workers * self.elapsed) \
+                if self.elapsed > 0 else None
+            stats.append({"stage": stage.name, "workers": stage.workers,
+                          "items": stage.items, "busy": stage.busy,
+                          "rate": rate, "usage": usage})
+        return stats
+
+    def __readSource(self,
+                     outQueue):
+        """
+        Thread that puts the source items into the first stage queue.
+
+        outQueue - the first stage queue or None if there are no stages
+        """
+        stage = self.sourceStage
+        try:
+            iterator = iter(self.source)
+            while not self.stopEvent.is_set():
+                begin = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stage.addTime(time.perf_counter() - begin)
+                if outQueue is not None:
+                    self.__put(outQueue, item)
+        except Exception as ex:
+            self.__fail(ex)
+        finally:
+            if outQueue is not None:
+                self.__put(outQueue, END)
+
+    def __runStage(self,
+                   stage,
+                   inQueue,
+                   outQueue,
+                   running):
+        """
+        Thread that applies the stage function to the items of its queue.
+
+        stage - Stage object
+        inQueue - the stage input queue
+        outQueue - the next stage queue or None if it is the last stage
+        running - one element list with the number of running threads of
+                  the stage
+        """
+        try:
+            while True:
+                item = self.__get(inQueue)
+                if item is END:
+                    self.__put(inQueue, END)  # for the other stage threads
+                    break
+                begin = time.perf_counter()
+                result = stage.function(item)
+                stage.addTime(time.perf_counter() - begin)
+                if outQueue is not None and result is not None:
+                    self.__put(outQueue, result)
+        except Exception as ex:
+            self.__fail(ex)
+        finally:
+            with stage.lock:
+                running[0] -= 1
+                last = running[0] == 0
+            if last:
+                try:
+                    if stage.finish is not None and \
+                       not self.stopEvent.is_set():
+                        stage.finish()
+                except Exception as ex:
+                    self.__fail(ex)
+                if outQueue is not None:
+                    self.__put(outQueue, END)
+
+    def __fail(self,
+               ex):
+        """
+        Stop all the pipeline threads.
+
+        ex - the exception that stopped the pipeline
+        """
+        self.errors.append(ex)
+        self.stopEvent.set()
+
+    def __get(self,
+              queue):
+        """
+        Get an item of a queue or END if the pipeline was stopped.
+
+        queue - the Queue object
+        """
+        while True:
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                if self.stopEvent.is_set():
+                    return END
+
+    def __put(self,
+              queue,
+              item):
+        """
+        Put an item into a queue, waiting while it is full, unless the
+        pipeline was stopped.
+
+        queue - the Queue object
+        item - the item
+        """
+        while not self.stopEvent.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
@@ -110,6 +110,7 @@ if __name__ == "__main__":
     factory_ = NLM_AOPFactory()
     factory_.setMyMongoId(mid)
     factory_.setMyMongoDoc(mdoc)
+    factory_.setMyMongoLog(mlog)
     factory_.setXmlOutDir("/bases/mdlG4/fasea/aheadofprint")
     # factory_.setXmlOutDir("../xml")
     factory_.setProcess(process)
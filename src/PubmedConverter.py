@@ -0,0 +1,441 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+from datetime import datetime
+
+__date__ = 20261018
+
+MONTHS = {"jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+          "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12}
+
+
+class PubmedConverter:
+    """
+    Convert a PubmedArticle xml element into a flat mongo document with the
+    fields used downstream (instead of the generic xmltodict structure).
+    Complete dates are stored as datetime objects and numbers as int.
+    """
+
+    def __init__(self,
+                 projection=None):
+        """
+
+        projection - list of the document fields to be extracted. If None
+                     all fields (see FIELDS) are extracted
+        """
+        fields = {
+            "pmid": self.__getPmid,
+            "status": self.__getStatus,
+            "owner": self.__getOwner,
+            "journal": self.__getJournal,
+            "title": self.__getTitle,
+            "vernacularTitle": self.__getVernacularTitle,
+            "abstract": self.__getAbstract,
+            "authors": self.__getAuthors,
+            "languages": self.__getLanguages,
+            "publicationTypes": self.__getPublicationTypes,
+            "pubDate": self.__getPubDate,
+            "pubYear": self.__getPubYear,
+            "articleDate": self.__getArticleDate,
+            "dateCompleted": self.__getDateCompleted,
+            "dateRevised": self.__getDateRevised,
+            "history": self.__getHistory,
+            "publicationStatus": self.__getPublicationStatus,
+            "ids": self.__getIds,
+            "keywords": self.__getKeywords,
+            "mesh": self.__getMesh
+        }
+        self.FIELDS = list(fields.keys())
+
+        if projection is None:
+            projection = self.FIELDS
+        for field in projection:
+            if field not in fields:
+                raise Exception("Invalid projection field: " + field)
+        self.extractors = [(field, fields[field]) for field in projection]
+
+    def convert(self,
+                element):
+        """
+
+        element - PubmedArticle xml element
+        Returns a dictionary with the projection fields. Absent fields are
+        not included
+        """
+        citation = element.find("MedlineCitation")
+        if citation is None:
+            raise Exception("Invalid PubmedArticle: no MedlineCitation")
+        data = element.find("PubmedData")
+
+        doc = {}
+        for field, extractor in self.extractors:
+            value = extractor(citation, data)
+            if value is not None and value != [] and value != {}:
+                doc[field] = value
+
+        return doc
+
+    def __getText(self,
+                  element):
+        """
+
+        element - xml element (can be None)
+        Returns all the text of an element (including the text of inline
+        children as <i> or <sup>) or None
+        """
+        if element is None:
+            return None
+        text = "".join(element.itertext()).strip()
+        return text or None
+
+    def __getDate(self,
+                  element):
+        """
+
+        element - xml element with Year, Month and Day children (can be
+                  None)
+        Returns a datetime if the date is complete or None
+        """
+        if element is None:
+            return None
+        year = element.findtext("Year")
+        month = element.findtext("Month")
+        day = element.findtext("Day")
+        try:
+            month = int(month) if month.isdigit() else \
+                MONTHS[month[:3].lower()]
+            return datetime(int(year), month, int(day))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    def __getPmid(self,
+                  citation,
+                  data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the PubMed id or None
+        """
+        return citation.findtext("PMID")
+
+    def __getStatus(self,
+                    citation,
+                    data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the MedlineCitation status (for example 'Publisher') or None
+        """
+        return citation.get("Status")
+
+    def __getOwner(self,
+                   citation,
+                   data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the MedlineCitation owner (for example 'NLM') or None
+        """
+        return citation.get("Owner")
+
+    def __getJournal(self,
+                     citation,
+                     data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a dictionary with the journal issn, titles, volume, issue and
+        Medline journal info
+        """
+        journal = {}
+        jour = citation.find("Article/Journal")
+        if jour is not None:
+            issn = jour.find("ISSN")
+            if issn is not None:
+                journal["issn"] = issn.text
+                journal["issnType"] = issn.get("IssnType")
+            journal["title"] = jour.findtext("Title")
+            journal["isoAbbreviation"] = jour.findtext("ISOAbbreviation")
+            journal["volume"] = jour.findtext("JournalIssue/Volume")
+            journal["issue"] = jour.findtext("JournalIssue/Issue")
+        info = citation.find("MedlineJournalInfo")
+        if info is not None:
+            journal["country"] = info.findtext("Country")
+            journal["medlineTA"] = info.findtext("MedlineTA")
+            journal["nlmUniqueId"] = info.findtext("NlmUniqueID")
+            journal["issnLinking"] = info.findtext("ISSNLinking")
+
+        return {key: val for key, val in journal.items() if val is not None}
+
+    def __getTitle(self,
+                   citation,
+                   data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the article title or None
+        """
+        return self.__getText(citation.find("Article/ArticleTitle"))
+
+    def __getVernacularTitle(self,
+                             citation,
+                             data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the article title in the original language or None
+        """
+        return self.__getText(citation.find("Article/VernacularTitle"))
+
+    def __getAbstract(self,
+                      citation,
+                      data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a list of abstract sections, each one a dictionary with text
+        and optional label and category
+        """
+        sections = []
+        for abst in citation.findall("Article/Abstract/AbstractText"):
+            section = {"text": self.__getText(abst)}
+            if abst.get("Label") is not None:
+                section["label"] = abst.get("Label")
+            if abst.get("NlmCategory") is not None:
+                section["category"] = abst.get("NlmCategory")
+            sections.append(section)
+
+        return sections
+
+    def __getAuthors(self,
+                     citation,
+                     data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a list of author dictionaries with names, orcid and
+        affiliations
+        """
+        authors = []
+        for auth in citation.findall("Article/AuthorList/Author"):
+            author = {"lastName": auth.findtext("LastName"),
+                      "foreName": auth.findtext("ForeName"),
+                      "initials": auth.findtext("Initials"),
+                      "collectiveName": auth.findtext("CollectiveName")}
+            author = {key: val for key, val in author.items()
+                      if val is not None}
+            for ident in auth.findall("Identifier"):
+                if ident.get("Source") == "ORCID":
+                    author["orcid"] = ident.text
+            affiliations = [self.__getText(aff) for aff in
+                            auth.findall("AffiliationInfo/Affiliation")]
+            if affiliations:
+                author["affiliations"] = affiliations
+            authors.append(author)
+
+        return authors
+
+    def __getLanguages(self,
+                       citation,
+                       data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a list of the article language codes
+        """
+        return [lang.text for lang in citation.findall("Article/Language")]
+
+    def __getPublicationTypes(self,
+                              citation,
+                              data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a list of the publication types
+        """
+        return [ptype.text for ptype in citation.findall(
+            "Article/PublicationTypeList/PublicationType")]
+
+    def __getPubDate(self,
+                     citation,
+                     data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the journal issue publication date as written in the xml
+        (it can be incomplete) or None
+        """
+        pubDate = citation.find("Article/Journal/JournalIssue/PubDate")
+        if pubDate is None:
+            return None
+        medlineDate = pubDate.findtext("MedlineDate")
+        if medlineDate is not None:
+            return medlineDate
+        date = [pubDate.findtext(tag) for tag in ["Year", "Month", "Day"]]
+        return " ".join([part for part in date if part is not None]) or None
+
+    def __getPubYear(self,
+                     citation,
+                     data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the journal issue publication year as int or None
+        """
+        pubDate = citation.find("Article/Journal/JournalIssue/PubDate")
+        if pubDate is None:
+            return None
+        year = pubDate.findtext("Year") or pubDate.findtext("MedlineDate")
+        if year is not None and year[:4].isdigit():
+            return int(year[:4])
+        return None
+
+    def __getArticleDate(self,
+                         citation,
+                         data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the electronic publication date as datetime or None
+        """
+        return self.__getDate(citation.find("Article/ArticleDate"))
+
+    def __getDateCompleted(self,
+                           citation,
+                           data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the Medline completion date as datetime or None
+        """
+        return self.__getDate(citation.find("DateCompleted"))
+
+    def __getDateRevised(self,
+                         citation,
+                         data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the Medline revision date as datetime or None
+        """
+        return self.__getDate(citation.find("DateRevised"))
+
+    def __getHistory(self,
+                     citation,
+                     data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a dictionary publication status -> datetime of the PubMed
+        history dates
+        """
+        history = {}
+        if data is not None:
+            for pubDate in data.findall("History/PubMedPubDate"):
+                date = self.__getDate(pubDate)
+                if date is not None:
+                    history[pubDate.get("PubStatus")] = date
+        return history
+
+    def __getPublicationStatus(self,
+                               citation,
+                               data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns the PubMed publication status (for example
+        'aheadofprint') or None
+        """
+        return None if data is None else data.findtext("PublicationStatus")
+
+    def __getIds(self,
+                 citation,
+                 data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a dictionary id type -> id (doi, pii, pubmed, pmc, ...)
+        """
+        ids = {}
+        for loc in citation.findall("Article/ELocationID"):
+            ids[loc.get("EIdType")] = loc.text
+        if data is not None:
+            for aid in data.findall("ArticleIdList/ArticleId"):
+                ids[aid.get("IdType")] = aid.text
+        return ids
+
+    def __getKeywords(self,
+                      citation,
+                      data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a list of the author keywords
+        """
+        return [self.__getText(kw) for kw in
+                citation.findall("KeywordList/Keyword")]
+
+    def __getMesh(self,
+                  citation,
+                  data):
+        """
+
+        citation - MedlineCitation xml element
+        data - PubmedData xml element (can be None)
+        Returns a list of MeSH headings, each one a dictionary with descriptor,
+        ui, majorTopic and optional qualifiers
+        """
+        mesh = []
+        for heading in citation.findall("MeshHeadingList/MeshHeading"):
+            desc = heading.find("DescriptorName")
+            if desc is None:
+                continue
+            term = {"descriptor": desc.text, "ui": desc.get("UI"),
+                    "majorTopic": desc.get("MajorTopicYN") == "Y"}
+            qualifiers = [qual.text for qual in
+                          heading.findall("QualifierName")]
+            if qualifiers:
+                term["qualifiers"] = qualifiers
+            mesh.append(term)
+        return mesh
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not a posix system, limit only this process
+    fcntl = None
+
+__date__ = 20261018
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter. The bucket receives 'rate' tokens per second
+    up to 'burst' tokens and each request consumes one token. It is thread
+    safe and, if a state file is given, the bucket is shared (under a file
+    lock) by all processes of the host that use the same file.
+    """
+
+    def __init__(self,
+                 rate=3,
+                 burst=1,
+                 stateFile=None):
+        """
+
+        rate - number of allowed requests per second
+        burst - maximum number of requests that can be sent at once
+        stateFile - path of the file used to share the bucket among
+                    processes. If None the bucket is private to this process
+        """
+        if rate <= 0:
+            raise Exception("rate <= 0")
+        if burst < 1:
+            raise Exception("burst < 1")
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.stateFile = stateFile if fcntl is not None else None
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request is allowed to be sent."""
+        while True:
+            with self.lock:
+                if self.stateFile is None:
+                    wait = self.__take()
+                else:
+                    wait = self.__takeShared()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+    def __take(self):
+        """
+        Refill the bucket and consume one token if it is available.
+
+        Returns 0 if a token was consumed or the number of seconds to wait
+        for the next one
+        """
+        now = time.time()
+        if now > self.last:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def __takeShared(self):
+        """
+        Same as __take but the bucket state is read from and written into
+        the state file while holding an exclusive lock on it.
+
+        Returns 0 if a token was consumed or the number of seconds to wait
+        for the next one
+        """
+        with open(self.stateFile, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                fields = f.read().split()
+                try:
+                    self.tokens = float(fields[0])
+                    self.last = float(fields[1])
+                except (IndexError, ValueError):
+                    self.tokens = self.burst
+                    self.last = time.time()
+
+                wait = self.__take()
+
+                f.seek(0)
+                f.truncate()
+                f.write(repr(self.tokens) + " " + repr(self.last))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        return wait
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# =========================================================================
+#
+#    Copyright © 2016 BIREME/PAHO/WHO
+#
+#    This file is part of API-NLM.
+#
+#    API-NLM is free software: you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 2.1 of
+#    the License, or (at your option) any later version.
+#
+#    API-NLM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with API-NLM. If not, see <http://www.gnu.org/licenses/>.
+#
+# =========================================================================
+
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import time
+
+__date__ = 20261018
+
+
+class RetryPolicy:
+    """
+    Retry policy of the http requests. Transient errors (connection errors,
+    timeouts, HTTP 408, 429 and 5xx) are retried after a jittered exponential
+    backoff or after the time asked by the 'Retry-After' header. Permanent
+    errors (other 4xx) are not retried.
+    """
+
+    def __init__(self,
+                 maxRetries=8,
+                 baseDelay=1.0,
+                 maxDelay=120.0,
+                 maxTotal=3600.0,
+                 timeout=60.0,
+                 verbose=False):
+        """
+
+        maxRetries - maximum number of retries of a request
+        baseDelay - backoff delay (seconds) of the first retry
+        maxDelay - maximum backoff delay (seconds) of one retry
+        maxTotal - maximum time (seconds) spent with one request including
+                   all its retries
+        timeout - socket timeout (seconds) of each request
+        verbose - if True print the waiting time before each retry
+        """
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.maxTotal = maxTotal
+        self.timeout = timeout
+        self.verbose = verbose
+
+    def isTransient(self,
+                    status):
+        """
+
+        status - http status code or -1 if the request could not be done
+        Returns True if the request should be tried again
+        """
+        return status in (-1, 408, 429) or 500 <= status < 600
+
+    def getRetryAfter(self,
+                      headers):
+        """
+
+        headers - http response headers
+        Returns the number of seconds asked by the 'Retry-After' header or
+        None if it is absent or invalid
+        """
+        if headers is None:
+            return None
+        value = headers.get("Retry-After")
+        if value is None:
+            return None
+
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+    def getDelay(self,
+                 attempt,
+                 headers=None):
+        """
+
+        attempt - number of the retry (first retry is 0)
+        headers - http response headers of the failed request
+        Returns the number of seconds to wait before the retry
+        """
+        retryAfter = self.getRetryAfter(headers)
+        if retryAfter is not None:
+            return retryAfter
+
+        # 'full jitter' backoff
+        return random.uniform(0, min(self.maxDelay,
+                                     self.baseDelay * (2 ** attempt)))
+
+    def call(self,
+             request):
+        """
+        Execute a request retrying it while the error is transient and the
+        retry budget is not exhausted.
+
+        request - function that receives the socket timeout and returns a
+                  tuple (<status>, <content>, <response headers>)
+        Returns the tuple of the last executed request
+        """
+        start = time.time()
+        attempt = 0
+
+        while True:
+            resp = request(self.timeout)
+            status = resp[0]
+            if 200 <= status < 300 or not self.isTransient(status) or \
+               attempt >= self.maxRetries:
+                break
+
+            delay = self.getDelay(attempt, resp[2])
+            if (time.time() - start) + delay > self.maxTotal:
+                break
+            if self.verbose:
+                print("(" + str(round(delay, 1)) + "s)", end="", flush=True)
+            time.sleep(delay)
+            attempt += 1
+
+        return resp
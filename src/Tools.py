@@ -22,7 +22,8 @@
 #
 # =========================================================================
 
-from os import listdir, makedirs, remove
+import hashlib
+from os import listdir, makedirs, remove, replace
 from os.path import isdir, exists, join
 import fnmatch
 import shutil
@@ -40,7 +41,8 @@ def xmlToFile(docId,
     Write the xml document into a file.
 
     docId - NLM document id
-    xml - string having xml content
+    xml - string having xml content or UTF-8 bytes (bytes, memoryview) that
+          are written without decoding when 'encoding' is UTF-8
     toDir - output file directory
     encoding - output file encoding
     includeXmlHeader - it True includes the header '<?xml ...' into file
@@ -56,6 +58,16 @@ def xmlToFile(docId,
     header = '<?xml version="1.0" encoding="UTF-8"?>'
     fname = str(docId) + ".xml"
 
+    if isinstance(xml, (bytes, bytearray, memoryview)):
+        if encoding.upper().replace("-", "") != "UTF8":
+            xml = str(xml, "utf-8").encode(encoding)
+        f = open(join(toDir, fname), mode="wb")
+        if includeXmlHeader:
+            f.write(header.encode(encoding) + b'\n')
+        f.write(xml)
+        f.close()
+        return
+
     f = open(join(toDir, fname), mode="w", encoding=encoding)
     if includeXmlHeader:
         f.write(header + '\n')
@@ -63,6 +75,19 @@ def xmlToFile(docId,
     f.close()
 
 
+def contentHash(xml):
+    """
+    Compute the hash of a xml document, used to check if it was changed.
+
+    xml - string having xml content or UTF-8 bytes (bytes, memoryview)
+    Returns the hexadecimal SHA-1 digest of the UTF-8 content
+    """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+
+    return hashlib.sha1(xml).hexdigest()
+
+
 def moveFile(fromDir,
              toDir,
              fileName,
@@ -208,6 +233,25 @@ def readFile2(filePath,
     return lines
 
 
+def writeFile(filePath,
+              str_,
+              encoding="UTF-8"):
+    """
+    Write a string into a file. The content is written into a temporary
+    file that replaces the original one, so a reader never sees a partially
+    written file.
+
+    filePath - the path (dir+name) of the file
+    str_ - the file content
+    encoding - character encoding of the file
+    """
+    tmpPath = filePath + ".tmp"
+    f = open(tmpPath, mode="w", encoding=encoding)
+    f.write(str_)
+    f.close()
+    replace(tmpPath, filePath)
+
+
 def removeFile(filePath):
     """
     Delete a file.
@@ -22,21 +22,73 @@
 #
 # =========================================================================
 
+import re
+import threading
 import xml.etree.ElementTree as ET
 
+try:
+    from lxml import etree as LET
+except ImportError:  # lxml is optional, ElementTree is used instead
+    LET = None
+
 __date__ = 20160418
 
+# Per thread lxml parser and compiled xpath expressions (lxml parsers and
+# XPath objects should not be shared among threads)
+lxmlCache = threading.local()
+
 
 class MyXML:
     def __init__(self,
-                 xmlStr):
+                 xmlStr,
+                 useLxml=True):
         """
 
         xmlStr - the xml string
+        useLxml - if True and lxml is installed it is used to parse the xml
+                  and to evaluate the xpath expressions (compiled once per
+                  expression). Otherwise ElementTree is used
         """
         self.xmlStr = xmlStr
-        self.root = ET.Element("super_root")
-        self.root.append(ET.fromstring(xmlStr))
+        self.lxml = useLxml and LET is not None
+        if self.lxml:
+            if not hasattr(lxmlCache, "parser"):
+                lxmlCache.parser = LET.XMLParser(remove_blank_text=False,
+                                                 resolve_entities=False)
+                lxmlCache.xpaths = {}
+            if isinstance(xmlStr, str):
+                xmlStr = xmlStr.encode("utf-8")
+            self.root = LET.fromstring(xmlStr, lxmlCache.parser)
+        else:
+            self.root = ET.Element("super_root")
+            self.root.append(ET.fromstring(xmlStr))
+
+    def __findall(self,
+                  xpath):
+        """
+
+        xpath - the xpath expression (relative to the document, the first
+                step is the root element)
+        Returns a list of xml elements
+        """
+        if not self.lxml:
+            return self.root.findall(xpath)
+
+        return self.__compile("/" + xpath)(self.root)
+
+    def __compile(self,
+                  xpath):
+        """
+
+        xpath - the lxml xpath expression
+        Returns the compiled expression, created only once per thread
+        """
+        compiled = lxmlCache.xpaths.get(xpath)
+        if compiled is None:
+            compiled = LET.XPath(xpath)
+            lxmlCache.xpaths[xpath] = compiled
+
+        return compiled
 
     def getXPath(self,
                  xpath):
@@ -47,9 +99,9 @@ class MyXML:
         retrieved xml element and the second it attribute
         """
         ret = []
-        xp = self.root.findall(xpath)
+        xp = self.__findall(xpath)
         for elem in xp:
-            ret.append((elem.text, elem.attrib))
+            ret.append((elem.text, dict(elem.attrib)))
 
         return ret
 
@@ -61,7 +113,7 @@ class MyXML:
         Returns a list of xml elements
         """
         # print("Element=" + str(self.root) + " xpath=" + xpath)
-        xp = self.root.findall(xpath)
+        xp = self.__findall(xpath)
         # print("xp len=" + str(len(xp)))
         return xp
 
@@ -74,6 +126,9 @@ class MyXML:
         child_tags - the tags of the desired xml child elements
         Returns the text of desired children of a given xml element
         """
+        if self.lxml:
+            return self.__getChildTextLxml(father_xpath, child_tags)
+
         ret = []
         fathers = self.root.findall(father_xpath)
         for father in fathers:
@@ -88,6 +143,37 @@ class MyXML:
 
         return ret
 
+    def __getChildTextLxml(self,
+                           father_xpath,
+                           child_tags):
+        """
+        Same as getXPathChildText but with only one compiled lxml query that
+        returns, in document order, each father followed by its desired
+        children.
+        """
+        father = "/" + father_xpath
+        children = " or ".join(["self::" + tag for tag in child_tags])
+        query = self.__compile(father + " | " + father + "/*[" + children +
+                               "]")
+        ret = []
+        texts = None
+        current = None
+
+        for elem in query(self.root):
+            if elem.getparent() is current and current is not None:
+                idx = child_tags.index(elem.tag)
+                if texts[idx] is None:  # only the first child of a tag
+                    texts[idx] = elem.text or ""
+            else:
+                if texts is not None:
+                    ret.append([txt or "" for txt in texts])
+                current = elem
+                texts = [None] * len(child_tags)
+        if texts is not None:
+            ret.append([txt or "" for txt in texts])
+
+        return ret
+
     def getTreeString(self,
                       element,
                       encoding="unicode"):
@@ -98,4 +184,136 @@ class MyXML:
         Returns a string having the tags, attributes and texts of all
         elements of a xml subtree
         """
+        if self.lxml:
+            return LET.tostring(element, encoding=encoding)
         return ET.tostring(element, encoding)
+
+
+def elementToDict(element):
+    """
+    Convert a xml element into a dictionary with the same structure
+    produced by xmltodict.parse: attributes are '@name' keys, the text of
+    an element with attributes or children is the '#text' key and repeated
+    children become lists.
+
+    element - the xml element
+    Returns a dictionary {<element tag>: <element value>}
+    """
+    def getValue(elem):
+        item = {}
+        for name, value in elem.attrib.items():
+            item["@" + name] = value
+
+        text = [elem.text] if elem.text else []
+        for child in elem:
+            if not isinstance(child.tag, str):  # lxml comments and PIs
+                if child.tail:
+                    text.append(child.tail)
+                continue
+            value = getValue(child)
+            if child.tag in item:
+                if isinstance(item[child.tag], list):
+                    item[child.tag].append(value)
+                else:
+                    item[child.tag] = [item[child.tag], value]
+            else:
+                item[child.tag] = value
+            if child.tail:
+                text.append(child.tail)
+
+        text = "".join(text).strip() or None
+        if not item:
+            return text
+        if text is not None:
+            item["#text"] = text
+        return item
+
+    return {element.tag: getValue(element)}
+
+
+def isSimplePath(xpath):
+    """
+
+    xpath - the xpath expression
+    Returns True if the expression is only a sequence of tags separated by
+    '/' (the kind of path supported by iterElements)
+    """
+    return re.fullmatch(r"[\w\-:{}]+(/[\w\-:{}]+)*", xpath) is not None
+
+
+def iterElements(xmlStr,
+                 xpath,
+                 chunkSize=65536):
+    """
+    Parse incrementally a xml document yielding each element of a simple
+    xpath as soon as its end tag is read. Yielded elements are removed from
+    the tree when the next one is requested, so the memory used does not
+    grow with the document size.
+
+    xmlStr - the xml string (str or bytes)
+    xpath - sequence of tags separated by '/' beginning with the root tag,
+            for example 'PubmedArticleSet/PubmedArticle'
+    chunkSize - number of characters given to the parser at each step
+    Returns an iterator of xml elements. Raises ET.ParseError if the
+    document is invalid or truncated
+    """
+    tags = xpath.split("/")
+    depth = len(tags)
+    parser = ET.XMLPullParser(events=("start", "end"))
+    stack = []  # open elements
+    path = []  # tags of the open elements
+
+    def readEvents():
+        for event, elem in parser.read_events():
+            if event == "start":
+                stack.append(elem)
+                path.append(elem.tag)
+            else:
+                if len(path) == depth and path == tags:
+                    yield elem
+                    if len(stack) > 1:
+                        stack[-2].remove(elem)
+                    else:
+                        elem.clear()
+                stack.pop()
+                path.pop()
+
+    for pos in range(0, len(xmlStr), chunkSize):
+        parser.feed(xmlStr[pos:pos + chunkSize])
+        yield from readEvents()
+    parser.close()
+    yield from readEvents()
+
+
+def iterRawElements(xmlBytes,
+                    xpath):
+    """
+    Find the elements of a simple xpath in the original bytes of a xml
+    document without parsing it. The last tag of the path should not be
+    nested into itself (as PubmedArticle).
+
+    xmlBytes - the xml document (bytes)
+    xpath - sequence of tags separated by '/' beginning with the root tag,
+            for example 'PubmedArticleSet/PubmedArticle'
+    Returns an iterator of memoryview slices of xmlBytes, one for each
+    element (from its start tag to its end tag). Raises ET.ParseError if
+    the document is truncated
+    """
+    tags = [re.escape(tag.encode("utf-8")) for tag in xpath.split("/")]
+    openTag = re.compile(b"<" + tags[-1] + rb"[\s/>]")
+    closeTag = re.compile(b"</" + tags[-1] + rb"\s*>")
+    if re.search(b"</" + tags[0] + rb"\s*>\s*$", xmlBytes) is None:
+        raise ET.ParseError("truncated xml document")
+
+    view = memoryview(xmlBytes)
+    pos = 0
+    while True:
+        begin = openTag.search(xmlBytes, pos)
+        if begin is None:
+            break
+        end = closeTag.search(xmlBytes, begin.end())
+        if end is None:
+            raise ET.ParseError("unclosed element at position " +
+                                str(begin.start()))
+        yield view[begin.start():end.end()]
+        pos = end.end()